@@ -27,6 +27,7 @@
 
 # Some high-level settings for the script:
 threads=20
+replicate_threads=10        # threads for each Rebaler replicate (replicates run in parallel)
 assembly_dir=assemblies     # where finished assemblies will go
 nanopolish_dir=nanopolish   # where Nanopolished assemblies will go
 results_dir=results         # where the result tables will go
@@ -47,7 +48,6 @@ fi
 
 # Various file paths that will be used along the way:
 read_data="$results_dir"/"$set"_reads.tsv
-read_alignment="$results_dir"/"$set"_reads.paf
 trimmed_reads="$assembly_dir"/"$set"_trimmed."$read_type"
 filtlong_reads="$assembly_dir"/"$set"_filtlong."$read_type"
 assembly_reads="$assembly_dir"/"$set"_assembly_reads.fastq
@@ -90,9 +90,7 @@ printf "\n\n\n"
 echo "ASSESS READS: "$set
 echo "--------------------------------------------------------------------------------"
 mkdir -p "$results_dir"
-minimap2 -x map-ont -t $threads -c reference.fasta $1 > $read_alignment
-pypy3 "$scripts_dir"/read_length_identity.py $1 $read_alignment > $read_data
-rm $read_alignment
+minimap2 -x map-ont -t $threads -c reference.fasta $1 | pypy3 "$scripts_dir"/read_length_identity.py --streaming $1 - > $read_data
 
 
 
@@ -111,20 +109,7 @@ if [ "$read_type" = "fasta" ]; then
 fi
 # Run multiple replicates of Racon on shuffled reads and a rotated reference.
 # Each assembly is then coursely shredded into 'reads' for the final Racon round.
-for i in {0..9}; do
-    sample_reads="$assembly_dir"/"$set"_sample_"$i"."$read_type"
-    sample_assembly="$assembly_dir"/"$set"_assembly_"$i".fasta
-    sample_reference="$assembly_dir"/"$set"_reference_"$i".fasta
-    if [ "$read_type" = "fastq" ]; then
-        cat $trimmed_reads | paste - - - - | shuf | awk -F'\t' '{OFS="\n"; print $1,$2,$3,$4}' > $sample_reads
-    elif [ "$read_type" = "fasta" ]; then
-        cat $trimmed_reads | paste - - | shuf | awk -F'\t' '{OFS="\n"; print $1,$2}' > $sample_reads
-    fi
-    "$scripts_dir"/rotate_reference.py reference.fasta $i > $sample_reference
-    rebaler -t $threads $sample_reference $sample_reads > $sample_assembly
-    "$scripts_dir"/shred_assembly.py $sample_assembly $i 50000 >> $assembly_reads
-    rm $sample_reads $sample_assembly $sample_reference
-done
+"$scripts_dir"/assembly_replicates.py --replicates 10 --threads $threads --replicate_threads $replicate_threads --temp_dir "$assembly_dir" $trimmed_reads reference.fasta $assembly_reads
 rm $trimmed_reads
 rebaler -t $threads reference.fasta $assembly_reads > $final_assembly
 rm $assembly_reads
@@ -137,7 +122,7 @@ echo "ASSESS ASSEMBLY: "$set
 echo "--------------------------------------------------------------------------------"
 python3 "$scripts_dir"/chop_up_assembly.py $final_assembly 10000 > $assembly_pieces
 minimap2 -x asm5 -t $threads -c reference.fasta $assembly_pieces > $assembly_alignment
-pypy3 "$scripts_dir"/read_length_identity.py $assembly_pieces $assembly_alignment > $assembly_data
+pypy3 "$scripts_dir"/read_length_identity.py --no_index $assembly_pieces $assembly_alignment > $assembly_data
 rm $assembly_pieces $assembly_alignment
 if [ ! -f "$results_dir"/assembly_error_details ]; then
     printf "assembly\tdcm\thomo_del\thomo_ins\tother_del\tother_ins\tsub\n" > "$results_dir"/assembly_error_details
@@ -145,10 +130,10 @@ fi
 printf $set"\t" >> "$results_dir"/assembly_error_details
 nucmer --prefix="$prefix" reference.fasta $final_assembly
 delta-filter -r -q "$prefix".delta > "$prefix".filter
-show-snps -ClrTH -x5 "$prefix".filter | python3 "$scripts_dir"/error_summary.py "$ref_contig" "$assembly_contig" >> "$results_dir"/assembly_error_details
+show-snps -ClrTH -x5 "$prefix".filter | python3 "$scripts_dir"/error_summary.py --substitution_count "$prefix".subs "$ref_contig" "$assembly_contig" >> "$results_dir"/assembly_error_details
 printf $set"\tassembly\t" >> "$results_dir"/substitution_counts
-show-snps -ClrTH "$prefix".filter | awk '$2 != "." && $3 != "."' | wc -l >> "$results_dir"/substitution_counts
-rm "$prefix".delta "$prefix".filter
+cat "$prefix".subs >> "$results_dir"/substitution_counts
+rm "$prefix".delta "$prefix".filter "$prefix".subs
 
 
 
@@ -180,7 +165,7 @@ echo "ASSESS NANOPOLISHED ASSEMBLY: "$set
 echo "--------------------------------------------------------------------------------"
 python3 "$scripts_dir"/chop_up_assembly.py $nanopolish_assembly 10000 > $nanopolish_pieces
 minimap2 -x asm5 -t $threads -c reference.fasta $nanopolish_pieces > $nanopolish_alignment
-pypy3 "$scripts_dir"/read_length_identity.py $nanopolish_pieces $nanopolish_alignment > $nanopolish_data
+pypy3 "$scripts_dir"/read_length_identity.py --no_index $nanopolish_pieces $nanopolish_alignment > $nanopolish_data
 rm $nanopolish_pieces $nanopolish_alignment
 if [ ! -f "$results_dir"/nanopolish_error_details ]; then
     printf "assembly\tdcm\thomo_del\thomo_ins\tother_del\tother_ins\tsub\n" > "$results_dir"/nanopolish_error_details
@@ -188,10 +173,10 @@ fi
 printf $set"\t" >> "$results_dir"/nanopolish_error_details
 nucmer --prefix="$prefix" reference.fasta $nanopolish_assembly
 delta-filter -r -q "$prefix".delta > "$prefix".filter
-show-snps -ClrTH -x5 "$prefix".filter | python3 "$scripts_dir"/error_summary.py "$ref_contig" "$assembly_contig" >> "$results_dir"/nanopolish_error_details
+show-snps -ClrTH -x5 "$prefix".filter | python3 "$scripts_dir"/error_summary.py --substitution_count "$prefix".subs "$ref_contig" "$assembly_contig" >> "$results_dir"/nanopolish_error_details
 printf $set"\tnanopolish\t" >> "$results_dir"/substitution_counts
-show-snps -ClrTH "$prefix".filter | awk '$2 != "." && $3 != "."' | wc -l >> "$results_dir"/substitution_counts
-rm "$prefix".delta "$prefix".filter
+cat "$prefix".subs >> "$results_dir"/substitution_counts
+rm "$prefix".delta "$prefix".filter "$prefix".subs
 
 
 
@@ -228,7 +213,7 @@ echo "ASSESS NANOPOLISHED (SECOND TIME) ASSEMBLY: "$set
 echo "--------------------------------------------------------------------------------"
 python3 "$scripts_dir"/chop_up_assembly.py $nanopolish_2_assembly 10000 > $nanopolish_2_pieces
 minimap2 -x asm5 -t $threads -c reference.fasta $nanopolish_2_pieces > $nanopolish_2_alignment
-pypy3 "$scripts_dir"/read_length_identity.py $nanopolish_2_pieces $nanopolish_2_alignment > $nanopolish_2_data
+pypy3 "$scripts_dir"/read_length_identity.py --no_index $nanopolish_2_pieces $nanopolish_2_alignment > $nanopolish_2_data
 rm $nanopolish_2_pieces $nanopolish_2_alignment
 if [ ! -f "$results_dir"/nanopolish_2_error_details ]; then
     printf "assembly\tdcm\thomo_del\thomo_ins\tother_del\tother_ins\tsub\n" > "$results_dir"/nanopolish_2_error_details
@@ -267,7 +252,7 @@ echo "ASSESS NANOPOLISHED (THIRD TIME) ASSEMBLY: "$set
 echo "--------------------------------------------------------------------------------"
 python3 "$scripts_dir"/chop_up_assembly.py $nanopolish_3_assembly 10000 > $nanopolish_3_pieces
 minimap2 -x asm5 -t $threads -c reference.fasta $nanopolish_3_pieces > $nanopolish_3_alignment
-pypy3 "$scripts_dir"/read_length_identity.py $nanopolish_3_pieces $nanopolish_3_alignment > $nanopolish_3_data
+pypy3 "$scripts_dir"/read_length_identity.py --no_index $nanopolish_3_pieces $nanopolish_3_alignment > $nanopolish_3_data
 rm $nanopolish_3_pieces $nanopolish_3_alignment
 if [ ! -f "$results_dir"/nanopolish_3_error_details ]; then
     printf "assembly\tdcm\thomo_del\thomo_ins\tother_del\tother_ins\tsub\n" > "$results_dir"/nanopolish_3_error_details
@@ -306,7 +291,7 @@ echo "ASSESS NANOPOLISHED (FOURTH TIME) ASSEMBLY: "$set
 echo "--------------------------------------------------------------------------------"
 python3 "$scripts_dir"/chop_up_assembly.py $nanopolish_4_assembly 10000 > $nanopolish_4_pieces
 minimap2 -x asm5 -t $threads -c reference.fasta $nanopolish_4_pieces > $nanopolish_4_alignment
-pypy3 "$scripts_dir"/read_length_identity.py $nanopolish_4_pieces $nanopolish_4_alignment > $nanopolish_4_data
+pypy3 "$scripts_dir"/read_length_identity.py --no_index $nanopolish_4_pieces $nanopolish_4_alignment > $nanopolish_4_data
 rm $nanopolish_4_pieces $nanopolish_4_alignment
 if [ ! -f "$results_dir"/nanopolish_4_error_details ]; then
     printf "assembly\tdcm\thomo_del\thomo_ins\tother_del\tother_ins\tsub\n" > "$results_dir"/nanopolish_4_error_details
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Copyright 2019 Ryan Wick (rrwick@gmail.com)
+https://github.com/rrwick/Basecalling-comparison
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. This program is distributed in the hope that it
+will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details. You should
+have received a copy of the GNU General Public License along with this program. If not, see
+<http://www.gnu.org/licenses/>.
+
+This script runs the replicate Rebaler assemblies used in assembly polishing. For each replicate
+(seeds 0 to n-1), it:
+  * writes the reads in a shuffled order
+  * writes a rotated reference (as rotate_reference.py does)
+  * runs Rebaler on them
+  * shreds the resulting assembly (as shred_assembly.py does) onto the end of the output FASTQ
+
+The reads are indexed once (see seq_index.py) and each shuffled copy is written by slicing records
+out of the memory-mapped read file, so they aren't parsed again for every replicate. The reads must
+be uncompressed with one line per sequence (and quality), as with the shell loop this replaces.
+
+Rebaler runs for more than one replicate can go at once: --threads is split between them, with
+--replicate_threads for each Rebaler run. Shreds are always appended in replicate order, so the
+output doesn't depend on which Rebaler run finishes first. If any replicate fails (or the script is
+interrupted), replicates that haven't started are cancelled and running Rebaler processes are
+stopped, along with the tools they run, before the script exits.
+
+The rotated references and shreds are the same as those from rotate_reference.py and
+shred_assembly.py with the same seeds. The read order for each replicate comes from Python's random
+module seeded with the replicate number (the shell loop used an unseeded shuf), so replicates are
+reproducible.
+"""
+
+import argparse
+import concurrent.futures
+import mmap
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+
+import reference_store
+import rotate_reference
+import seq_index
+import seq_io
+import shred_assembly
+
+
+WRITE_BUFFER_SIZE = 1 << 20
+STOP_WAIT_SECONDS = 10  # how long a stopped Rebaler process has to exit before it is killed
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Make shredded reads from replicate assemblies')
+
+    parser.add_argument('--replicates', type=int, required=False, default=10,
+                        help='Number of replicate assemblies')
+    parser.add_argument('--threads', type=int, required=False, default=1,
+                        help='Total number of threads to use')
+    parser.add_argument('--replicate_threads', type=int, required=False, default=None,
+                        help='Number of threads for each Rebaler run (default: --threads, i.e. '
+                             'one replicate at a time)')
+    parser.add_argument('--shred_length', type=int, required=False, default=50000,
+                        help='Length of the reads made by shredding each assembly')
+    parser.add_argument('--temp_dir', type=str, required=False, default=None,
+                        help='Directory for the replicates\' temporary files (default: the '
+                             'output\'s directory)')
+
+    parser.add_argument('reads', type=str,
+                        help='Trimmed reads (uncompressed FASTA or FASTQ)')
+    parser.add_argument('reference', type=str,
+                        help='One-contig circular reference (FASTA)')
+    parser.add_argument('out', type=str,
+                        help='FASTQ file to which the shredded reads will be appended')
+
+    args = parser.parse_args()
+    if args.replicate_threads is None:
+        args.replicate_threads = args.threads
+    if args.threads < 1 or args.replicate_threads < 1:
+        sys.exit('Error: thread counts must be at least 1')
+    if args.temp_dir is None:
+        args.temp_dir = os.path.dirname(os.path.abspath(args.out))
+    return args
+
+
+def main():
+    args = get_arguments()
+    if seq_io.get_compression_type(args.reads) != 'plain':
+        sys.exit('Error: ' + args.reads + ' must be uncompressed')
+    read_type = seq_io.get_sequence_file_type(args.reads).lower()
+    record_extents = get_record_extents(args.reads)
+    reference = reference_store.load_reference_store(args.reference)
+
+    parallel = max(1, args.threads // args.replicate_threads)
+    print('Running {} replicate{}, {} at a time with {} thread{} each'.format(
+        args.replicates, '' if args.replicates == 1 else 's', parallel, args.replicate_threads,
+        '' if args.replicate_threads == 1 else 's'), file=sys.stderr)
+
+    temp_dir = tempfile.mkdtemp(prefix='replicates_', dir=args.temp_dir)
+    rebaler_processes = RebalerProcesses()
+    try:
+        with open(args.reads, 'rb') as reads_file, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+            reads = mmap.mmap(reads_file.fileno(), 0, access=mmap.ACCESS_READ) \
+                if record_extents else b''
+            futures = [executor.submit(run_replicate, i, reads, record_extents, read_type,
+                                       reference, args.replicate_threads, temp_dir,
+                                       rebaler_processes)
+                       for i in range(args.replicates)]
+            try:
+                with open(args.out, 'ab') as out:
+                    for i in range(len(futures)):
+                        sample_assembly = wait_for_replicate(futures, i)
+                        append_shreds(sample_assembly, i, args.shred_length, out)
+                        os.remove(sample_assembly)
+                        print('Replicate {} complete'.format(i), file=sys.stderr)
+            except RuntimeError as e:
+                stop_replicates(futures, rebaler_processes)
+                sys.exit('Error: ' + str(e))
+            except BaseException:
+                stop_replicates(futures, rebaler_processes)
+                raise
+    finally:
+        for filename in os.listdir(temp_dir):
+            os.remove(os.path.join(temp_dir, filename))
+        os.rmdir(temp_dir)
+
+
+def get_record_extents(reads_filename):
+    """
+    Returns a list of (start, end) byte positions for each record in the read file, in file order.
+    """
+    _, _, offsets = seq_index.load_index(reads_filename, write_index=False)
+    file_size = os.path.getsize(reads_filename)
+    ends = list(offsets[1:]) + [file_size]
+    return list(zip(offsets, ends))
+
+
+def wait_for_replicate(futures, i):
+    """
+    Returns the assembly from replicate i, but raises the error from any later replicate that fails
+    first, so a failure isn't held up until the earlier replicates finish.
+    """
+    while True:
+        for future in futures[i:]:
+            if future.done() and future.exception() is not None:
+                future.result()
+        if futures[i].done():
+            return futures[i].result()
+        concurrent.futures.wait([f for f in futures[i:] if not f.done()],
+                                return_when=concurrent.futures.FIRST_COMPLETED)
+
+
+def stop_replicates(futures, rebaler_processes):
+    """
+    Cancels the replicates that haven't started and stops the running Rebaler processes, so leaving
+    the executor doesn't wait for them to finish.
+    """
+    for future in futures:
+        future.cancel()
+    rebaler_processes.stop_all()
+
+
+class RebalerProcesses(object):
+    """
+    Keeps track of the running Rebaler processes so they can be stopped if a replicate fails. Each
+    Rebaler run gets its own process group, so stopping it also stops the tools it runs.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.processes = set()
+        self.stopped = False
+
+    def run(self, command, stdout):
+        """
+        Runs the command and returns its exit status, or None if the runs have been stopped.
+        """
+        with self.lock:
+            if self.stopped:
+                return None
+            process = subprocess.Popen(command, stdout=stdout, start_new_session=True)
+            self.processes.add(process)
+        try:
+            process.wait()
+        finally:
+            with self.lock:
+                self.processes.discard(process)
+        return None if self.stopped else process.returncode
+
+    def stop_all(self):
+        with self.lock:
+            self.stopped = True
+            processes = list(self.processes)
+        for process in processes:
+            signal_process_group(process, signal.SIGTERM)
+        for process in processes:
+            try:
+                process.wait(timeout=STOP_WAIT_SECONDS)
+            except subprocess.TimeoutExpired:
+                signal_process_group(process, signal.SIGKILL)
+
+
+def signal_process_group(process, sig):
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def run_replicate(i, reads, record_extents, read_type, reference, threads, temp_dir,
+                  rebaler_processes):
+    """
+    Writes the shuffled reads and rotated reference for one replicate and runs Rebaler on them.
+    Returns the filename of the resulting assembly.
+    """
+    sample_reads = os.path.join(temp_dir, 'sample_{}.{}'.format(i, read_type))
+    sample_reference = os.path.join(temp_dir, 'reference_{}.fasta'.format(i))
+    sample_assembly = os.path.join(temp_dir, 'assembly_{}.fasta'.format(i))
+
+    with open(sample_reads, 'wb', buffering=WRITE_BUFFER_SIZE) as reads_out:
+        write_shuffled_reads(reads, record_extents, i, reads_out)
+    with open(sample_reference, 'wb', buffering=WRITE_BUFFER_SIZE) as reference_out:
+        rotate_reference.write_rotated_reference(reference, i, reference_out)
+
+    with open(sample_assembly, 'wb') as assembly_out:
+        try:
+            returncode = rebaler_processes.run(['rebaler', '-t', str(threads), sample_reference,
+                                                sample_reads], assembly_out)
+        except OSError as e:
+            raise RuntimeError('could not run rebaler ({})'.format(e.strerror))
+    os.remove(sample_reads)
+    os.remove(sample_reference)
+    if returncode is None:
+        raise RuntimeError('replicate {} stopped'.format(i))
+    if returncode != 0:
+        raise RuntimeError('rebaler failed on replicate {} (exit status {})'.format(
+            i, returncode))
+    return sample_assembly
+
+
+def write_shuffled_reads(reads, record_extents, seed, out):
+    order = list(range(len(record_extents)))
+    random.Random(seed).shuffle(order)
+    for j in order:
+        start, end = record_extents[j]
+        record = reads[start:end]
+        out.write(record)
+        if not record.endswith(b'\n'):
+            out.write(b'\n')
+
+
+def append_shreds(assembly_filename, seed, shred_length, out):
+    assembly = reference_store.load_reference_store(assembly_filename, cache=False)
+    shred_assembly.write_shreds(assembly, seed, shred_length, out)
+
+
+if __name__ == '__main__':
+    main()
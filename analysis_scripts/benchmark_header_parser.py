@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Copyright 2019 Ryan Wick (rrwick@gmail.com)
+https://github.com/rrwick/Basecalling-comparison
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. This program is distributed in the hope that it
+will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details. You should
+have received a copy of the GNU General Public License along with this program. If not, see
+<http://www.gnu.org/licenses/>.
+
+This script measures how quickly fix_read_names.py finds the read ID or fast5 name in read headers.
+
+It makes synthetic headers in each basecaller's layout and times three ways of parsing them:
+  * old re.search: the uncompiled re.search calls (for both patterns) fix_read_names.py used to
+    make for each read
+  * compiled search: the same searches with precompiled patterns, and nothing else
+  * HeaderParser: fix_read_names.HeaderParser.parse, which also counts the header layouts
+The headers are split evenly between the layouts. Each way's results are checked against the old
+one, and HeaderParser's layout for each header is checked against the layout it was made in.
+
+Usage:
+  benchmark_header_parser.py --headers 10000000
+"""
+
+import argparse
+import random
+import re
+import sys
+import time
+import uuid
+
+import fix_read_names
+
+
+METHODS = ['old re.search', 'compiled search', 'HeaderParser']
+DISTINCT_HEADERS = 10000  # headers made for each layout, then reused to reach the total
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Time read header parsing in fix_read_names.py')
+
+    parser.add_argument('--headers', type=int, required=False, default=10000000,
+                        help='Total number of headers to parse with each method')
+    parser.add_argument('--seed', type=int, required=False, default=0,
+                        help='Random seed for the synthetic headers')
+
+    args = parser.parse_args()
+    if args.headers < 1:
+        sys.exit('Error: --headers must be at least 1')
+    return args
+
+
+def main():
+    args = get_arguments()
+    rng = random.Random(args.seed)
+    layouts = get_layouts()
+    per_layout = max(args.headers // len(layouts), 1)
+    print('{:,} headers for each of {} layouts'.format(per_layout, len(layouts)))
+    print('\t'.join(['Layout'] + ['{} (us/header)'.format(m) for m in METHODS] + ['Checked']))
+
+    totals = [0.0] * len(METHODS)
+    for layout_name, expected_layout, make_header in layouts:
+        headers = [make_header(rng) for _ in range(min(per_layout, DISTINCT_HEADERS))]
+        checked = check_headers(headers, expected_layout)
+        headers = (headers * (per_layout // len(headers) + 1))[:per_layout]
+        seconds = [time_method(method, headers) for method in METHODS]
+        totals = [t + s for t, s in zip(totals, seconds)]
+        print('\t'.join([layout_name] + ['{:.3f}'.format(1000000 * s / per_layout)
+                                         for s in seconds] + [str(checked)]), flush=True)
+    print('\t'.join(['Total (s)'] + ['{:.1f}'.format(t) for t in totals]))
+
+
+def get_layouts():
+    """
+    Returns (name, layout HeaderParser should report, header function) for each synthetic layout.
+    """
+    return [('Guppy', 'Guppy', make_guppy_header),
+            ('Albacore 1', 'Albacore', make_albacore_1_header),
+            ('Albacore 2', 'Albacore', make_albacore_2_header),
+            ('Flappie', 'Flappie', make_flappie_header),
+            ('Scrappie', 'Scrappie', make_scrappie_header),
+            ('Chiron', 'Chiron', make_fast5_name)]
+
+
+def make_read_id(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def make_fast5_name(rng):
+    return '5210_N{}_20170425_FN{}_MN19691_sequencing_run_klebs_033_{}_ch{}_read{}_strand'.format(
+        rng.randint(100000, 999999), rng.randint(1000000000, 9999999999),
+        rng.randint(10000, 99999), rng.randint(1, 512), rng.randint(1, 50000))
+
+
+def make_run_tags(rng):
+    return 'runid={:040x} read={} ch={} start_time=2017-04-25T{:02d}:{:02d}:{:02d}Z'.format(
+        rng.getrandbits(160), rng.randint(1, 50000), rng.randint(1, 512), rng.randint(0, 23),
+        rng.randint(0, 59), rng.randint(0, 59))
+
+
+def make_guppy_header(rng):
+    return '{} {} flow_cell_id=FAH{:05d} protocol_group_id=klebs_033 sample_id=klebs'.format(
+        make_read_id(rng), make_run_tags(rng), rng.randint(0, 99999))
+
+
+def make_albacore_1_header(rng):
+    return '{}_Basecall_1D_template {}'.format(make_read_id(rng), make_fast5_name(rng))
+
+
+def make_albacore_2_header(rng):
+    return '{} {}'.format(make_read_id(rng), make_run_tags(rng))
+
+
+def make_flappie_header(rng):
+    read_id = make_read_id(rng)
+    return '{}  {{ "filename" : "{}.fast5", "uuid" : "{}", "normalised_score" : {:.6f}, ' \
+           '"nblock" : {}, "sequence_length" : {} }}'.format(
+               read_id, make_fast5_name(rng), read_id, rng.uniform(-2, 0),
+               rng.randint(1000, 50000), rng.randint(1000, 50000))
+
+
+def make_scrappie_header(rng):
+    return '{}  {{ "normalised_score" : {:.6f}, "nblock" : {}, "sequence_length" : {}, ' \
+           '"blocks_per_second" : 4000.000000, "nevents" : {}, "event_rate" : {:.6f}, ' \
+           '"mean_qscore" : {:.6f} }}'.format(
+               make_fast5_name(rng), rng.uniform(-2, 0), rng.randint(1000, 50000),
+               rng.randint(1000, 50000), rng.randint(1000, 50000), rng.uniform(0, 1),
+               rng.uniform(5, 15))
+
+
+def parse_old(header):
+    read_id, fast5_name = None, None
+    try:
+        read_id = re.search(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}',
+                            header).group(0)
+    except AttributeError:
+        read_id = None
+    try:
+        fast5_name = re.search(r'\w+_ch\d+_read\d+_\w+', header).group(0)
+    except AttributeError:
+        fast5_name = None
+    if read_id is not None:
+        return read_id, None
+    return None, fast5_name
+
+
+def parse_compiled(header):
+    match = fix_read_names.READ_ID_PATTERN.search(header)
+    if match is not None:
+        return match.group(0), None
+    return None, fix_read_names.FAST5_NAME_PATTERN.search(header).group(0)
+
+
+def check_headers(headers, expected_layout):
+    """
+    Returns whether every method gives the old results for the headers, and whether HeaderParser
+    puts them all in the expected layout.
+    """
+    header_parser = fix_read_names.HeaderParser()
+    for header in headers:
+        result = parse_old(header)
+        if parse_compiled(header) != result or header_parser.parse(header) != result:
+            return False
+    return header_parser.layout_counts[expected_layout] == len(headers)
+
+
+def time_method(method, headers):
+    if method == 'old re.search':
+        parse = parse_old
+    elif method == 'compiled search':
+        parse = parse_compiled
+    else:
+        parse = fix_read_names.HeaderParser().parse
+    start_time = time.time()
+    for header in headers:
+        parse(header)
+    return time.time() - start_time
+
+
+if __name__ == '__main__':
+    main()
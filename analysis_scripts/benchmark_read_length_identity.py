@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Copyright 2019 Ryan Wick (rrwick@gmail.com)
+https://github.com/rrwick/Basecalling-comparison
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. This program is distributed in the hope that it
+will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details. You should
+have received a copy of the GNU General Public License along with this program. If not, see
+<http://www.gnu.org/licenses/>.
+
+This script measures how read_length_identity.py scales with --threads.
+
+It makes a synthetic read set and PAF (sorted by read name, as the pipeline uses them), then times
+read_length_identity.py on them for each thread count (1, 2, 4, ... up to --max_threads), in both
+--streaming and indexed mode. Each run's output is checked against the one-thread output.
+
+Usage:
+  benchmark_read_length_identity.py --max_threads 20 --python pypy3
+"""
+
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Time read_length_identity.py with different '
+                                                 'thread counts')
+
+    parser.add_argument('--alignments', type=int, required=False, default=1000000,
+                        help='Number of PAF alignments to make')
+    parser.add_argument('--alignments_per_read', type=int, required=False, default=5,
+                        help='Average number of alignments for each read')
+    parser.add_argument('--max_threads', type=int, required=False, default=os.cpu_count(),
+                        help='Largest thread count to time (default: number of CPUs)')
+    parser.add_argument('--python', type=str, required=False, default=sys.executable,
+                        help='Python interpreter used to run read_length_identity.py')
+    parser.add_argument('--temp_dir', type=str, required=False, default=None,
+                        help='Directory for the synthetic reads and PAF')
+    parser.add_argument('--seed', type=int, required=False, default=0,
+                        help='Random seed for the synthetic data')
+
+    args = parser.parse_args()
+    if args.alignments < 1 or args.alignments_per_read < 1 or args.max_threads < 1:
+        sys.exit('Error: counts must be at least 1')
+    return args
+
+
+def main():
+    args = get_arguments()
+    script = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'read_length_identity.py')
+    temp_dir = tempfile.mkdtemp(prefix='rli_benchmark_', dir=args.temp_dir)
+    try:
+        reads = os.path.join(temp_dir, 'reads.fasta')
+        paf = os.path.join(temp_dir, 'alignments.paf')
+        read_count = make_data(reads, paf, args.alignments, args.alignments_per_read, args.seed)
+        print('{:,} reads, {:,} alignments, {} CPUs'.format(read_count, args.alignments,
+                                                             os.cpu_count()))
+        print('\t'.join(['Mode', 'Threads', 'Seconds', 'Speed-up', 'Same output']))
+        for mode in ['streaming', 'indexed']:
+            one_thread_time, one_thread_output = None, None
+            for threads in get_thread_counts(args.max_threads):
+                output = os.path.join(temp_dir, 'out_{}_{}.tsv'.format(mode, threads))
+                seconds = time_run(args.python, script, mode, threads, reads, paf, output)
+                with open(output, 'rb') as f:
+                    output_data = f.read()
+                os.remove(output)
+                if one_thread_time is None:
+                    one_thread_time, one_thread_output = seconds, output_data
+                print('{}\t{}\t{:.2f}\t{:.2f}\t{}'.format(mode, threads, seconds,
+                                                          one_thread_time / seconds,
+                                                          output_data == one_thread_output),
+                      flush=True)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def get_thread_counts(max_threads):
+    thread_counts, threads = [], 1
+    while threads < max_threads:
+        thread_counts.append(threads)
+        threads *= 2
+    return thread_counts + [max_threads]
+
+
+def make_data(reads_filename, paf_filename, alignment_count, alignments_per_read, seed):
+    """
+    Writes reads (FASTA, with short sequences to keep the file small, since the work depends on the
+    number of alignments) and a PAF with a varying number of alignments per read. Returns the
+    number of reads.
+    """
+    rng = random.Random(seed)
+    read_num, alignments_left = 0, alignment_count
+    with open(reads_filename, 'wt') as reads, open(paf_filename, 'wt') as paf:
+        while alignments_left > 0:
+            read_name = 'read{:08d}'.format(read_num)
+            read_length = rng.randint(200, 2000)
+            reads.write('>{}\n{}\n'.format(read_name, 'A' * read_length))
+            count = min(alignments_left, rng.randint(1, 2 * alignments_per_read - 1))
+            for _ in range(count):
+                read_start = rng.randint(0, read_length - 100)
+                read_end = rng.randint(read_start + 100, read_length)
+                ref_start = rng.randint(0, 4000000)
+                ref_end = ref_start + read_end - read_start + rng.randint(-50, 50)
+                block_length = max(ref_end - ref_start, read_end - read_start)
+                matches = rng.randint(block_length * 3 // 4, block_length)
+                paf.write('\t'.join(str(x) for x in [read_name, read_length, read_start, read_end,
+                                                     '+', 'ref', 5000000, ref_start, ref_end,
+                                                     matches, block_length, 60]) + '\n')
+            alignments_left -= count
+            read_num += 1
+    return read_num
+
+
+def time_run(python, script, mode, threads, reads, paf, output):
+    command = [python, script, '--threads', str(threads)]
+    command += ['--streaming'] if mode == 'streaming' else ['--no_index']
+    command += [reads, paf]
+    start_time = time.time()
+    with open(output, 'wb') as out:
+        subprocess.run(command, stdout=out, stderr=subprocess.DEVNULL, check=True)
+    return time.time() - start_time
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Copyright 2019 Ryan Wick (rrwick@gmail.com)
+https://github.com/rrwick/Basecalling-comparison
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. This program is distributed in the hope that it
+will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details. You should
+have received a copy of the GNU General Public License along with this program. If not, see
+<http://www.gnu.org/licenses/>.
+
+This script measures the load time and peak memory (RSS) of the ways reference_store.py can load a
+FASTA file.
+
+It makes a synthetic FASTA and then, each in a fresh process, loads it and takes a 1 kb slice of
+every contig:
+  * old load_fasta: the line-by-line loader each script used to have its own copy of, which holds
+    every contig as a str
+  * in memory: load_reference_store(cache=False), as used for FASTA files which are read once
+  * build store: load_reference_store() with no .refstore file, so the packed file is made
+  * reopen store: load_reference_store() again, so the packed file is just mapped into memory
+A process which only imports the module is also measured, to show the interpreter's own RSS.
+
+Usage:
+  benchmark_reference_store.py --genome_size 200000000 --contigs 20 --python pypy3
+"""
+
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+# Run in each child process: prints the seconds taken and the peak RSS (in kB on Linux).
+CHILD_CODE = '''
+import resource, sys, time
+sys.path.insert(0, sys.argv[1])
+import reference_store
+
+
+def load_fasta(fasta_filename):
+    fasta_seqs = []
+    with open(fasta_filename, 'rt') as fasta_file:
+        name = ''
+        sequence = []
+        for line in fasta_file:
+            line = line.strip()
+            if not line:
+                continue
+            if line[0] == '>':  # Header line = start of new contig
+                if name:
+                    fasta_seqs.append((name.split()[0], ''.join(sequence), name))
+                    sequence = []
+                name = line[1:]
+            else:
+                sequence.append(line)
+        if name:
+            fasta_seqs.append((name.split()[0], ''.join(sequence), name))
+    return fasta_seqs
+
+
+start_time = time.time()
+if sys.argv[2] == 'old load_fasta':
+    for _, seq, _ in load_fasta(sys.argv[3]):
+        seq[len(seq) // 2:len(seq) // 2 + 1000]
+elif sys.argv[2] != 'import only':
+    store = reference_store.load_reference_store(sys.argv[3], cache=(sys.argv[2] != 'in memory'))
+    for name, length, _ in store.iterate_contigs():
+        store.get_sequence(name, length // 2, length // 2 + 1000)
+seconds = time.time() - start_time
+print(seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+MODES = ['import only', 'old load_fasta', 'in memory', 'build store', 'reopen store']
+BASE_TABLE = bytes(b'ACGT'[i % 4] for i in range(256))
+BLOCK_SIZE = 1020000  # a multiple of the line length
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Time reference_store.py loading a FASTA')
+
+    parser.add_argument('--genome_size', type=int, required=False, default=5000000,
+                        help='Total size of the synthetic FASTA')
+    parser.add_argument('--contigs', type=int, required=False, default=1,
+                        help='Number of contigs in the synthetic FASTA')
+    parser.add_argument('--python', type=str, required=False, default=sys.executable,
+                        help='Python interpreter used to load the FASTA')
+    parser.add_argument('--temp_dir', type=str, required=False, default=None,
+                        help='Directory for the synthetic FASTA')
+    parser.add_argument('--seed', type=int, required=False, default=0,
+                        help='Random seed for the synthetic data')
+
+    args = parser.parse_args()
+    if args.genome_size < 1 or args.contigs < 1:
+        sys.exit('Error: sizes must be at least 1')
+    return args
+
+
+def main():
+    args = get_arguments()
+    scripts_dir = os.path.dirname(os.path.realpath(__file__))
+    temp_dir = tempfile.mkdtemp(prefix='refstore_benchmark_', dir=args.temp_dir)
+    try:
+        fasta = os.path.join(temp_dir, 'reference.fasta')
+        make_fasta(fasta, args.genome_size, args.contigs, args.seed)
+        print('{:,} bp in {} contig{}'.format(args.genome_size, args.contigs,
+                                             '' if args.contigs == 1 else 's'))
+        print('\t'.join(['Mode', 'Seconds', 'Peak RSS (MB)']))
+        for mode in MODES:
+            seconds, max_rss = time_load(args.python, scripts_dir, mode, fasta)
+            print('{}\t{:.2f}\t{:.1f}'.format(mode, seconds, max_rss / 1024), flush=True)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def make_fasta(fasta_filename, genome_size, contig_count, seed):
+    """
+    Writes random contigs (with 60 bp lines) which add up to genome_size. Bases are made from
+    random bytes in 1 Mb blocks, which is much quicker than choosing them one at a time.
+    """
+    rng = random.Random(seed)
+    with open(fasta_filename, 'wb') as fasta:
+        for i in range(contig_count):
+            length = genome_size // contig_count + (1 if i < genome_size % contig_count else 0)
+            fasta.write('>contig_{}\n'.format(i + 1).encode())
+            for block_start in range(0, length, BLOCK_SIZE):
+                block_length = min(BLOCK_SIZE, length - block_start)
+                block = rng.getrandbits(block_length * 8).to_bytes(block_length, 'little')
+                block = block.translate(BASE_TABLE)
+                fasta.write(b''.join(block[j:j + 60] + b'\n' for j in range(0, block_length, 60)))
+
+
+def time_load(python, scripts_dir, mode, fasta):
+    output = subprocess.run([python, '-c', CHILD_CODE, scripts_dir, mode, fasta],
+                            stdout=subprocess.PIPE, check=True).stdout.decode().split()
+    return float(output[0]), int(output[1])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Copyright 2019 Ryan Wick (rrwick@gmail.com)
+https://github.com/rrwick/Basecalling-comparison
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. This program is distributed in the hope that it
+will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details. You should
+have received a copy of the GNU General Public License along with this program. If not, see
+<http://www.gnu.org/licenses/>.
+
+This script measures the throughput (MB/s of uncompressed FASTQ) of seq_io.py's parser against the
+text-mode loaders it replaced.
+
+It makes a synthetic FASTQ, plain and gzipped, and times two jobs on each (best of --repeats):
+  * lengths: each read's name and length, as read_length_identity.py needs (old:
+    iterate_fastq_lengths, new: seq_index.build_index)
+  * full load: each read's header, sequence and qualities, as fix_read_names.py needs (old:
+    load_fastq, new: fix_read_names.load_fasta_or_fastq)
+The old and new results are checked against each other.
+
+Usage:
+  benchmark_seq_io.py --reads 12000 --read_length 4000
+"""
+
+import argparse
+import gzip
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+import fix_read_names
+import seq_index
+
+
+JOBS = ['lengths', 'full load']
+BASE_TABLE = bytes(b'ACGT'[i % 4] for i in range(256))
+QUAL_TABLE = bytes(33 + (i % 40) for i in range(256))
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Time seq_io.py against the old FASTQ loaders')
+
+    parser.add_argument('--reads', type=int, required=False, default=12000,
+                        help='Number of reads in the synthetic FASTQ')
+    parser.add_argument('--read_length', type=int, required=False, default=4000,
+                        help='Mean read length (lengths vary from half to 1.5 times this)')
+    parser.add_argument('--repeats', type=int, required=False, default=3,
+                        help='Number of times to run each job (the best time is reported)')
+    parser.add_argument('--temp_dir', type=str, required=False, default=None,
+                        help='Directory for the synthetic FASTQ files')
+    parser.add_argument('--seed', type=int, required=False, default=0,
+                        help='Random seed for the synthetic data')
+
+    args = parser.parse_args()
+    if args.reads < 2 or args.read_length < 2 or args.repeats < 1:
+        sys.exit('Error: --reads and --read_length must be at least 2, --repeats at least 1')
+    return args
+
+
+def main():
+    args = get_arguments()
+    temp_dir = tempfile.mkdtemp(prefix='seq_io_benchmark_', dir=args.temp_dir)
+    try:
+        plain = os.path.join(temp_dir, 'reads.fastq')
+        make_fastq(plain, args.reads, args.read_length, args.seed)
+        gzipped = plain + '.gz'
+        with open(plain, 'rb') as plain_file, gzip.open(gzipped, 'wb') as gzipped_file:
+            shutil.copyfileobj(plain_file, gzipped_file)
+        megabytes = os.path.getsize(plain) / 1000000
+        print('{:,} reads, {:.1f} MB uncompressed, {:.1f} MB gzipped'.format(
+            args.reads, megabytes, os.path.getsize(gzipped) / 1000000))
+
+        print('\t'.join(['Input', 'Job', 'Old (MB/s)', 'New (MB/s)', 'Speed-up', 'Same result']))
+        for input_name, filename in [('plain', plain), ('gzipped', gzipped)]:
+            for job in JOBS:
+                old_seconds, old_result = time_job(job, 'old', filename, args.repeats)
+                new_seconds, new_result = time_job(job, 'new', filename, args.repeats)
+                print('{}\t{}\t{:.0f}\t{:.0f}\t{:.2f}\t{}'.format(
+                    input_name, job, megabytes / old_seconds, megabytes / new_seconds,
+                    old_seconds / new_seconds, old_result == new_result), flush=True)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def make_fastq(fastq_filename, read_count, read_length, seed):
+    rng = random.Random(seed)
+    with open(fastq_filename, 'wb') as fastq:
+        for _ in range(read_count):
+            length = rng.randint(read_length // 2, read_length * 3 // 2)
+            header = '{} runid={:040x} read={} ch={}'.format(
+                uuid.UUID(int=rng.getrandbits(128), version=4), rng.getrandbits(160),
+                rng.randint(1, 50000), rng.randint(1, 512))
+            seq = rng.getrandbits(length * 8).to_bytes(length, 'little').translate(BASE_TABLE)
+            qual = rng.getrandbits(length * 8).to_bytes(length, 'little').translate(QUAL_TABLE)
+            fastq.write(b'@' + header.encode() + b'\n' + seq + b'\n+\n' + qual + b'\n')
+
+
+def time_job(job, version, filename, repeats):
+    """
+    Returns the best time for a job and its result (as comparable lists).
+    """
+    best_seconds, result = None, None
+    for _ in range(repeats):
+        start_time = time.time()
+        if job == 'lengths' and version == 'old':
+            result = list(iterate_fastq_lengths(filename))
+        elif job == 'lengths':
+            names, lengths, _ = seq_index.build_index(filename)
+            result = list(zip(names, lengths))
+        elif version == 'old':
+            result = load_fastq(filename)
+        else:
+            result = list(fix_read_names.load_fasta_or_fastq(filename)[0])
+        seconds = time.time() - start_time
+        if best_seconds is None or seconds < best_seconds:
+            best_seconds = seconds
+    if job == 'full load' and version == 'new':
+        result = [(header, seq.decode(), qual.decode()) for header, seq, qual in result]
+    return best_seconds, result
+
+
+# The loaders below are the old ones from read_length_identity.py and fix_read_names.py.
+
+
+def get_open_func(filename):
+    with open(filename, 'rb') as unknown_file:
+        return gzip.open if unknown_file.read(3) == b'\x1f\x8b\x08' else open
+
+
+def iterate_fastq_lengths(fastq_filename):
+    with get_open_func(fastq_filename)(fastq_filename, 'rt') as fastq:
+        for line in fastq:
+            name = line.strip()[1:].split()[0]
+            sequence = next(fastq).strip()
+            next(fastq)
+            next(fastq)
+            yield name, len(sequence)
+
+
+def load_fastq(fastq_filename):
+    open_func = get_open_func(fastq_filename)
+    reads = []
+
+    extra_empty_line = False
+    with open_func(fastq_filename, 'rt') as fastq:
+        for line in fastq:
+            _ = next(fastq)
+            _ = next(fastq)
+            _ = next(fastq)
+            fifth_line = next(fastq).strip()
+            if len(fifth_line) == 0:
+                extra_empty_line = True
+            break
+
+    with open_func(fastq_filename, 'rt') as fastq:
+        for line in fastq:
+            name = line.strip()[1:]
+            sequence = next(fastq).strip()
+            _ = next(fastq)
+            qualities = next(fastq).strip()
+            if extra_empty_line:
+                _ = next(fastq)
+            reads.append((name, sequence, qualities))
+    return reads
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Copyright 2019 Ryan Wick (rrwick@gmail.com)
+https://github.com/rrwick/Basecalling-comparison
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. This program is distributed in the hope that it
+will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details. You should
+have received a copy of the GNU General Public License along with this program. If not, see
+<http://www.gnu.org/licenses/>.
+
+This script measures sequence_utils.reverse_complement against the per-base function that
+rotate_reference.py, shred_assembly.py and filter_reads.py each used to have, at the sizes and
+types those scripts use:
+  * rotate_reference: a whole 5 Mb chromosome (now reverse complemented as bytes)
+  * shred_assembly: a 50 kb shred (bytes)
+  * filter_reads: a 20 kb per-read reference (str)
+The old function always works on a str. Each result is checked against the old one.
+
+Usage:
+  benchmark_sequence_utils.py --repeats 5
+"""
+
+import argparse
+import random
+import sys
+import time
+
+import sequence_utils
+
+
+# (call site, sequence length, type of sequence now used there)
+CALL_SITES = [('rotate_reference', 5000000, bytes),
+              ('shred_assembly', 50000, bytes),
+              ('filter_reads', 20000, str)]
+TIMED_SECONDS = 0.5  # each function is called repeatedly for at least this long
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Time sequence_utils.reverse_complement')
+
+    parser.add_argument('--repeats', type=int, required=False, default=3,
+                        help='Number of timing runs for each function (the best is reported)')
+    parser.add_argument('--seed', type=int, required=False, default=0,
+                        help='Random seed for the synthetic sequences')
+
+    args = parser.parse_args()
+    if args.repeats < 1:
+        sys.exit('Error: --repeats must be at least 1')
+    return args
+
+
+def main():
+    args = get_arguments()
+    rng = random.Random(args.seed)
+    print('\t'.join(['Call site', 'Length', 'Old (ms/call)', 'New (ms/call)', 'Speed-up',
+                     'Same result']))
+    for call_site, length, seq_type in CALL_SITES:
+        seq = make_sequence(rng, length)
+        new_seq = seq.encode() if seq_type is bytes else seq
+        old_result = old_reverse_complement(seq)
+        new_result = sequence_utils.reverse_complement(new_seq)
+        if seq_type is bytes:
+            new_result = new_result.decode()
+        old_seconds = time_function(old_reverse_complement, seq, args.repeats)
+        new_seconds = time_function(sequence_utils.reverse_complement, new_seq, args.repeats)
+        print('{}\t{:,}\t{:.3f}\t{:.3f}\t{:.0f}\t{}'.format(
+            call_site, length, 1000 * old_seconds, 1000 * new_seconds, old_seconds / new_seconds,
+            old_result == new_result), flush=True)
+
+
+def make_sequence(rng, length):
+    """
+    Returns a random sequence, mostly ACGT but with some lowercase bases and IUPAC codes.
+    """
+    seq = bytearray(rng.getrandbits(length * 8).to_bytes(length, 'little').translate(
+        bytes(b'ACGT'[i % 4] for i in range(256))))
+    for _ in range(length // 1000):
+        pos = rng.randrange(length)
+        seq[pos:pos + 10] = seq[pos:pos + 10].lower()
+        seq[rng.randrange(length)] = ord(rng.choice('NRYSWKMBDHV'))
+    return seq.decode()
+
+
+def time_function(function, seq, repeats):
+    """
+    Returns the best time per call over several runs of repeated calls.
+    """
+    best = None
+    for _ in range(repeats):
+        calls, start_time = 0, time.time()
+        while True:
+            function(seq)
+            calls += 1
+            seconds = time.time() - start_time
+            if seconds >= TIMED_SECONDS:
+                break
+        if best is None or seconds / calls < best:
+            best = seconds / calls
+    return best
+
+
+# The old per-base reverse complement, which the scripts used before sequence_utils.py.
+REV_COMP_DICT = sequence_utils.REV_COMP_DICT
+
+
+def complement_base(base):
+    try:
+        return REV_COMP_DICT[base]
+    except KeyError:
+        return 'N'
+
+
+def old_reverse_complement(seq):
+    return ''.join([complement_base(x) for x in seq][::-1])
+
+
+if __name__ == '__main__':
+    main()
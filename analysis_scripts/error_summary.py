@@ -24,53 +24,111 @@ nucmer --prefix="$prefix" "$ref_fasta" "$assembly_fasta"
 delta-filter -r -q "$prefix".delta > "$prefix".filter
 rm "$prefix".delta
 show-snps -ClrTH -x5 "$prefix".filter | python3 error_summary.py "$ref_contig" "$assembly_contig"
+
+Given a contig pair, it outputs one line of error rates for that pair. Without a contig pair, all
+pairs are summarised in one pass over the SNPs, giving a table with one row per pair (in the order
+they first appear). Each pair's error rates are per base of the assembly contig's length, which
+comes from the show-snps LEN column. If the given contig pair has no SNPs (a perfect assembly), its
+error rates are all zero.
+
+With --substitution_count, the total number of substitutions (SNPs where neither base is a gap, in
+all contig pairs) is also saved to a file. This is the same as:
+show-snps -ClrTH "$prefix".filter | awk '$2 != "." && $3 != "."' | wc -l
 """
 
+import argparse
 import collections
 import math
 import sys
 
 
 homo_lengths_to_count = [3, 4, 5, 6, 7, 8]
+ERROR_TYPES = ['dcm', 'homo del', 'homo ins', 'other del', 'other ins', 'sub']
 
 
-def main():
-    r_contig = sys.argv[1]
-    a_contig = sys.argv[2]
-
-    r_length, alignment_length = None, None
-    snp_count = 0
-    homo_ins_count, non_homo_ins_count = 0, 0
-    homo_del_count, non_homo_del_count = 0, 0
-    homo_ins_counts = collections.defaultdict(int)
-    homo_del_counts = collections.defaultdict(int)
-    sub_count = 0
-    dcm_count, no_motif_count = 0, 0
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Summarise assembly errors from show-snps output '
+                                                 '(show-snps -ClrTH -x5) on stdin')
 
-    error_type_counts = collections.defaultdict(int)
- 
-    for line in sys.stdin:
-        parts = line.strip().split('\t')
-        if parts[12] != r_contig or parts[13] != a_contig:
-            continue
+    parser.add_argument('--substitution_count', type=str, required=False, default=None,
+                        help='Save the number of substitutions (in all contig pairs) to this file')
+
+    parser.add_argument('r_contig', type=str, nargs='?', default=None,
+                        help='Reference contig name (default: summarise all contig pairs)')
+    parser.add_argument('a_contig', type=str, nargs='?', default=None,
+                        help='Assembly contig name')
+
+    args = parser.parse_args()
+    if args.r_contig is not None and args.a_contig is None:
+        sys.exit('Error: an assembly contig name is needed along with the reference contig name')
+    return args
 
-        if r_length is None:
-            r_length = int(parts[7])
-            alignment_length = r_length
-        snp_count += 1
+
+def main():
+    args = get_arguments()
+    pair_lengths, pair_snp_counts, substitution_count = load_snps(sys.stdin)
+
+    if args.substitution_count is not None:
+        with open(args.substitution_count, 'wt') as substitution_count_file:
+            print(substitution_count, file=substitution_count_file)
+
+    if args.r_contig is not None:
+        pair = (args.r_contig, args.a_contig)
+        if pair in pair_lengths:
+            print_error_rates(pair_snp_counts[pair], pair_lengths[pair])
+        else:  # no SNPs for this pair, so every error rate is zero
+            print('\t'.join('{:.7f}'.format(0.0) for _ in ERROR_TYPES))
+    else:
+        print('\t'.join(['Ref contig', 'Assembly contig'] + ERROR_TYPES))
+        for pair, length in pair_lengths.items():
+            print('\t'.join(pair), end='\t')
+            print_error_rates(pair_snp_counts[pair], length)
+
+
+def load_snps(snps):
+    """
+    Reads show-snps lines and returns:
+      * the length of each (ref contig, assembly contig) pair, in the order the pairs appear
+      * for each pair, a Counter of (ref base, assembly base, ref context)
+      * the number of substitutions in all pairs
+    """
+    pair_lengths = collections.OrderedDict()
+    pair_snp_counts = collections.defaultdict(collections.Counter)
+    substitution_count = 0
+    for line in snps:
+        parts = line.strip().split('\t')
+        pair = (parts[12], parts[13])
+        if pair not in pair_lengths:
+            pair_lengths[pair] = int(parts[7])
         r_base = parts[1]
         a_base = parts[2]
         ref_seq = parts[8]
+        pair_snp_counts[pair][(r_base, a_base, ref_seq)] += 1
+        if r_base != '.' and a_base != '.':
+            substitution_count += 1
+    return pair_lengths, pair_snp_counts, substitution_count
 
-        error_type = get_error_type(r_base, a_base, ref_seq)
-        error_type_counts[error_type] += 1
 
-    for error_type in ['dcm', 'homo del', 'homo ins', 'other del', 'other ins', 'sub']:
-        rate = error_type_counts[error_type] / r_length
+def print_error_rates(snp_counts, length):
+    error_type_counts = get_error_type_counts(snp_counts)
+    for error_type in ERROR_TYPES:
+        rate = error_type_counts[error_type] / length
         end_char = '\n' if error_type == 'sub' else '\t'
         print('{:.7f}'.format(rate), end=end_char)
 
 
+def get_error_type_counts(snp_counts):
+    """
+    Takes a Counter of (ref base, assembly base, ref context) and returns the number of errors of
+    each type. Many SNPs share the same bases and context (e.g. the same homopolymer error in
+    different places), so each distinct combination is only classified once.
+    """
+    error_type_counts = collections.defaultdict(int)
+    for (r_base, a_base, ref_seq), count in snp_counts.items():
+        error_type_counts[get_error_type(r_base, a_base, ref_seq)] += count
+    return error_type_counts
+
+
 def get_deletion_homopolymer_length(seq):
     seq_len = len(seq)
     middle_i = seq_len // 2
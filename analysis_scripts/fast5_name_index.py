@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Copyright 2019 Ryan Wick (rrwick@gmail.com)
+https://github.com/rrwick/Basecalling-comparison
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. This program is distributed in the hope that it
+will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details. You should
+have received a copy of the GNU General Public License along with this program. If not, see
+<http://www.gnu.org/licenses/>.
+
+This module holds a compact, memory-mapped index of a read_id_to_fast5 file (read IDs in the first
+column, fast5 filenames in the second), for looking up fast5 names by read ID and vice versa.
+
+Read IDs are stored as 16-byte binary UUIDs in a sorted table. The fast5 names are split into a
+prefix (everything before the last '_ch', i.e. the run name, flowcell, sample ID, etc.) which is
+stored once per distinct value, and a short suffix (e.g. '_ch225_read22973_strand'). For fast5 name
+lookups, there is a second table of 4-byte CRC32 name hashes, also sorted. Both tables have a
+bucket table giving where each leading 16-bit value starts, so a lookup only searches a small slice.
+
+The index is built with bulk operations (one sort of the read IDs and one of the name hashes,
+bisects for the bucket tables and C-level maps for the rest), so building it doesn't take much
+longer than loading the file into dictionaries. Read IDs are sorted as text, which gives the same
+order as sorting their binary form.
+
+The index is saved next to the read_id_to_fast5 file (with a .f5idx extension) and is keyed on that
+file's size and modification time, so later runs just map it into memory. If it can't be saved
+there, it is built in a temporary file instead.
+
+Index layout (little-endian, all integers unsigned unless noted, each section starting on an
+8-byte boundary so the integer tables can be used in place):
+  * 8-byte magic
+  * header: source size, source mtime (ns, signed), entry count, prefix count, prefix bytes,
+    suffix bytes (6 x 8 bytes)
+  * prefix offsets: (prefix count + 1) 8-byte ints, followed by the prefix bytes (zero-padded)
+  * read ID buckets: 65537 8-byte ints
+  * read IDs: 16 bytes each, sorted
+  * fast5 name suffix offsets, in read ID order: (entry count + 1) 8-byte ints
+  * name hash buckets: 65537 8-byte ints
+  * fast5 name prefix numbers, in read ID order: 4-byte ints
+  * name hashes: 4-byte ints, sorted
+  * name positions: 4-byte read ID table position for each name hash
+  * suffix bytes
+"""
+
+import array
+import binascii
+import bisect
+import contextlib
+import gc
+import itertools
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+import zlib
+
+import seq_index
+
+
+INDEX_EXTENSION = '.f5idx'
+INDEX_MAGIC = b'F5IDX\x00\x00\x02'
+INDEX_HEADER = struct.Struct('<QqQQQQ')
+BUCKET_COUNT = 1 << 16
+READ_ID_SIZE = 16
+
+READ_ID_PATTERN = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+
+def load_fast5_name_index(read_id_to_fast5_filename):
+    """
+    Returns a Fast5NameIndex for the file, or None if the file's read IDs aren't all UUIDs (in
+    which case the caller should fall back to dictionaries).
+    """
+    stamp = seq_index.get_file_stamp(read_id_to_fast5_filename)
+    index_filename = read_id_to_fast5_filename + INDEX_EXTENSION
+    try:
+        with open(index_filename, 'rb') as index_file:
+            index = Fast5NameIndex(index_file)
+        if index.stamp == stamp:
+            return index
+    except (OSError, ValueError):
+        pass
+
+    with paused_gc():
+        entries = load_entries(read_id_to_fast5_filename)
+    if entries is None:
+        return None
+    temp_filename = index_filename + '.temp'
+    try:
+        with open(temp_filename, 'wb') as index_file, paused_gc():
+            write_index(index_file, stamp, entries)
+        os.replace(temp_filename, index_filename)
+        with open(index_filename, 'rb') as index_file:
+            return Fast5NameIndex(index_file)
+    except OSError as e:
+        print('Warning: could not write {} ({})'.format(index_filename, e.strerror),
+              file=sys.stderr)
+    with tempfile.TemporaryFile() as index_file, paused_gc():
+        write_index(index_file, stamp, entries)
+        index_file.flush()
+        return Fast5NameIndex(index_file)
+
+
+def load_entries(read_id_to_fast5_filename):
+    """
+    Returns (read IDs, fast5 names) from the file as two lists of bytes, sorted by read ID and
+    checked for duplicate read IDs and fast5 names. Returns None if any read ID isn't a lowercase
+    UUID.
+    """
+    with open(read_id_to_fast5_filename, 'rb') as read_id_to_fast5_file:
+        lines = read_id_to_fast5_file.read().split(b'\n')
+
+    rows = [parts for parts in (line.strip().split(b'\t') for line in lines) if len(parts) == 2]
+    del lines
+    if not rows:
+        return [], []
+    read_ids, fast5_names = zip(*rows)
+    del rows
+    if not all_read_ids_valid(read_ids):
+        return None
+    fast5_names = [name[:-6] if name.endswith(b'.fast5') else name for name in fast5_names]
+
+    read_id_to_fast5 = dict(zip(read_ids, fast5_names))
+    if len(read_id_to_fast5) != len(read_ids):
+        sys.exit('Error: duplicate read ID in ' + read_id_to_fast5_filename + ': ' +
+                 get_duplicate(read_ids).decode())
+    if len(set(fast5_names)) != len(fast5_names):
+        sys.exit('Error: duplicate fast5 in ' + read_id_to_fast5_filename + ': ' +
+                 get_duplicate(fast5_names).decode())
+    read_ids = sorted(read_id_to_fast5)
+    return read_ids, list(map(read_id_to_fast5.__getitem__, read_ids))
+
+
+def all_read_ids_valid(read_ids):
+    """
+    Checks that every read ID matches READ_ID_PATTERN, using whole-list operations: each ID must be
+    36 bytes with dashes in the right places and only lowercase hex digits elsewhere.
+    """
+    if set(map(len, read_ids)) != {36}:
+        return False
+    joined = b''.join(read_ids)
+    for dash_pos in (8, 13, 18, 23):
+        if joined[dash_pos::36].count(b'-') != len(read_ids):
+            return False
+    return not joined.replace(b'-', b'').translate(None, b'0123456789abcdef')
+
+
+@contextlib.contextmanager
+def paused_gc():
+    """
+    Building the index makes millions of small objects but no reference cycles, so the garbage
+    collector is paused while it runs (it would otherwise spend most of the time rescanning them).
+    """
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def get_duplicate(values):
+    seen = set()
+    for value in values:
+        if value in seen:
+            return value
+        seen.add(value)
+
+
+def get_buckets(sorted_keys, get_bucket_key):
+    """
+    Returns the position of the first key in each bucket (plus the total key count at the end),
+    where get_bucket_key gives the smallest possible key in a bucket.
+    """
+    buckets = array.array('Q', (bisect.bisect_left(sorted_keys, get_bucket_key(i))
+                                for i in range(BUCKET_COUNT)))
+    buckets.append(len(sorted_keys))
+    return buckets
+
+
+def get_read_id_bucket_key(bucket):
+    return '{:04x}'.format(bucket).encode()
+
+
+def get_name_hash_bucket_key(bucket):
+    return bucket << 16
+
+
+def write_uint_array(index_file, typecode, values):
+    values = array.array(typecode, values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    values.tofile(index_file)
+
+
+def write_index(index_file, stamp, entries):
+    read_ids, fast5_names = entries
+    name_parts = [name.rpartition(b'_ch') for name in fast5_names]
+    prefixes = [prefix for prefix, _, _ in name_parts]
+    suffixes = [separator + suffix for _, separator, suffix in name_parts]
+    distinct_prefixes = sorted(set(prefixes))
+    prefix_numbers = {prefix: i for i, prefix in enumerate(distinct_prefixes)}
+    prefix_offsets = [0] + list(itertools.accumulate(map(len, distinct_prefixes)))
+    suffix_offsets = [0] + list(itertools.accumulate(map(len, suffixes)))
+
+    # The name hashes are sorted with their read ID table positions.
+    name_hashes = list(map(zlib.crc32, fast5_names))
+    name_positions = sorted(range(len(name_hashes)), key=name_hashes.__getitem__)
+    name_hashes = list(map(name_hashes.__getitem__, name_positions))
+
+    index_file.write(INDEX_MAGIC)
+    index_file.write(INDEX_HEADER.pack(stamp[0], stamp[1], len(read_ids), len(distinct_prefixes),
+                                       prefix_offsets[-1], suffix_offsets[-1]))
+    write_uint_array(index_file, 'Q', prefix_offsets)
+    index_file.write(b''.join(distinct_prefixes))
+    index_file.write(bytes(get_padding(prefix_offsets[-1])))
+    write_uint_array(index_file, 'Q', get_buckets(read_ids, get_read_id_bucket_key))
+    index_file.write(binascii.unhexlify(b''.join(read_ids).replace(b'-', b'')))
+    write_uint_array(index_file, 'Q', suffix_offsets)
+    write_uint_array(index_file, 'Q', get_buckets(name_hashes, get_name_hash_bucket_key))
+    write_uint_array(index_file, 'I', map(prefix_numbers.__getitem__, prefixes))
+    write_uint_array(index_file, 'I', name_hashes)
+    write_uint_array(index_file, 'I', name_positions)
+    index_file.write(b''.join(suffixes))
+
+
+def get_padding(size):
+    return -size % 8
+
+
+class Fast5NameIndex(object):
+    """
+    A read-only view of an index file, memory-mapped so that opening it is nearly instant. The
+    integer tables are used in place through memoryviews (copied only on big-endian machines).
+    Lookups raise KeyError for unknown keys, like a dictionary would.
+    """
+    def __init__(self, index_file):
+        self.data = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError('not a fast5 name index')
+        pos = len(INDEX_MAGIC)
+        size, mtime, count, prefix_count, prefix_size, suffix_size = \
+            INDEX_HEADER.unpack_from(self.data, pos)
+        self.stamp = (size, mtime)
+        pos += INDEX_HEADER.size
+
+        prefix_offsets, pos = self.get_uint_table('Q', pos, prefix_count + 1)
+        prefix_bytes = self.data[pos:pos + prefix_size]
+        self.prefixes = [prefix_bytes[prefix_offsets[i]:prefix_offsets[i+1]].decode()
+                         for i in range(prefix_count)]
+        pos += prefix_size + get_padding(prefix_size)
+
+        self.read_id_buckets, pos = self.get_uint_table('Q', pos, BUCKET_COUNT + 1)
+        self.read_ids_start = pos
+        pos += READ_ID_SIZE * count
+        self.suffix_offsets, pos = self.get_uint_table('Q', pos, count + 1)
+        self.name_hash_buckets, pos = self.get_uint_table('Q', pos, BUCKET_COUNT + 1)
+        self.prefix_numbers, pos = self.get_uint_table('I', pos, count)
+        self.name_hashes, pos = self.get_uint_table('I', pos, count)
+        self.name_positions, pos = self.get_uint_table('I', pos, count)
+        self.suffixes_start = pos
+        if len(self.data) != pos + suffix_size:
+            raise ValueError('truncated fast5 name index')
+
+    def get_uint_table(self, typecode, pos, count):
+        """
+        Returns a table of unsigned ints in the index (and the position after it).
+        """
+        end = pos + array.array(typecode).itemsize * count
+        if end > len(self.data):
+            raise ValueError('truncated fast5 name index')
+        if sys.byteorder == 'big':
+            values = array.array(typecode)
+            values.frombytes(self.data[pos:end])
+            values.byteswap()
+        else:
+            values = memoryview(self.data)[pos:end].cast(typecode)
+        return values, end
+
+    def get_fast5(self, read_id):
+        try:
+            key = bytes.fromhex(read_id.replace('-', ''))
+        except ValueError:
+            raise KeyError(read_id)
+        if len(key) != READ_ID_SIZE:
+            raise KeyError(read_id)
+
+        # Read IDs are unique, so the first match in the key's bucket which is aligned to a key
+        # boundary is the one.
+        bucket = (key[0] << 8) | key[1]
+        start = self.read_ids_start + READ_ID_SIZE * self.read_id_buckets[bucket]
+        end = self.read_ids_start + READ_ID_SIZE * self.read_id_buckets[bucket + 1]
+        match = self.data.find(key, start, end)
+        while match != -1:
+            if (match - self.read_ids_start) % READ_ID_SIZE == 0:
+                return self.get_fast5_at((match - self.read_ids_start) // READ_ID_SIZE)
+            match = self.data.find(key, match + 1, end)
+        raise KeyError(read_id)
+
+    def get_read_id(self, fast5_name):
+        name_hash = zlib.crc32(fast5_name.encode())
+        bucket = name_hash >> 16
+        i = bisect.bisect_left(self.name_hashes, name_hash, self.name_hash_buckets[bucket],
+                               self.name_hash_buckets[bucket + 1])
+
+        # Different names can share a hash, so each match is checked against the full name.
+        while i < len(self.name_hashes) and self.name_hashes[i] == name_hash:
+            position = self.name_positions[i]
+            if self.get_fast5_at(position) == fast5_name:
+                return self.get_read_id_at(position)
+            i += 1
+        raise KeyError(fast5_name)
+
+    def get_fast5_at(self, position):
+        suffix_start = self.suffixes_start + self.suffix_offsets[position]
+        suffix_end = self.suffixes_start + self.suffix_offsets[position + 1]
+        return self.prefixes[self.prefix_numbers[position]] + \
+            self.data[suffix_start:suffix_end].decode()
+
+    def get_read_id_at(self, position):
+        read_id_start = self.read_ids_start + READ_ID_SIZE * position
+        h = self.data[read_id_start:read_id_start + READ_ID_SIZE].hex()
+        return '{}-{}-{}-{}-{}'.format(h[:8], h[8:12], h[12:16], h[16:20], h[20:])
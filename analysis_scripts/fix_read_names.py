@@ -15,31 +15,109 @@ This script adjusts read headers to be consistent between basecallers and compat
 Nanopolish. After running, each read header should be in this format:
 5a8d447e-84e2-4f6f-922c-5ad7269f688c_Basecall_1D_template 5210_N125509_20170425_FN2002039725_MN19691_sequencing_run_klebs_033_restart_87298_ch152_read14914_strand
 
-It also sorts the reads alphabetically by their new headers and removes 0-length reads.
+It also sorts the reads alphabetically by their new headers and removes 0-length reads. For read
+sets too big to sort in memory, use --sort_memory to do an external merge sort with temporary files.
+If the reads are already in order of their new headers, use --sorted_input to stream each read
+straight through without building a read list. The new headers start with the read ID, so this is
+the case for this script's own output and for reads sorted by a read ID at the start of the header.
+It is not the case for raw basecaller output (which isn't sorted) or for headers with only a fast5
+name, and the script stops with an error if it finds a read out of order.
 
 Usage:
-fix_read_names.py input_reads.fastq.gz read_id_to_fast5 | gzip > output_reads.fastq.gz
+fix_read_names.py --threads 8 -o output_reads.fastq.gz input_reads.fastq.gz read_id_to_fast5
 
-It can take either fasta or fastq input and will output in the same format.
+It can take either fasta or fastq input and will output in the same format. If the output filename
+ends in .gz, it is written as block-gzipped (BGZF) data, compressed using the given number of
+threads. Without -o, uncompressed reads are written to stdout.
 
 The read_id_to_fast5 file is a tab-delimited file with read IDs in the first column and fast5
 filenames in the second. For example:
 00052d2b-be8b-4649-b6d5-9bdbd88a1ea5	5210_N128870_20170602_FN_MN20200_sequencing_run_sample_id_99953_ch225_read22973_strand.fast5
 0005323f-791d-4bd1-bd5f-3f110cb72b08	5210_N128870_20170602_FN_MN20200_sequencing_run_sample_id_99953_ch341_read18592_strand.fast5
 00077d28-f985-4800-898e-d4baede5d2aa	5210_N128870_20170602_FN_MN20200_sequencing_run_sample_id_99953_ch117_read27051_strand.fast5
+
+A compact index of this file (see fast5_name_index.py) is saved next to it with a .f5idx extension,
+so later runs with the same read_id_to_fast5 file can load it instantly. If the read IDs aren't all
+UUIDs, the file is loaded into dictionaries instead.
 """
 
-import sys
+import argparse
+import collections
+import contextlib
+import heapq
 import os
-import gzip
 import re
+import sys
+import tempfile
+
+import fast5_name_index
+import seq_io
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Make read headers consistent between basecallers')
+
+    parser.add_argument('-o', '--output', type=str, required=False, default=None,
+                        help='Output read file (BGZF-compressed if it ends in .gz, default: '
+                             'uncompressed to stdout)')
+    parser.add_argument('--threads', type=int, required=False, default=1,
+                        help='Threads to use for compressing the output')
+    parser.add_argument('--sort_memory', type=float, required=False, default=None,
+                        help='Memory budget (in MB) for sorting reads - if given, sorted runs of '
+                             'reads are spilled to temporary files and then merged (default: sort '
+                             'all reads in memory)')
+    parser.add_argument('--sorted_input', action='store_true',
+                        help='The input reads are already in order of their new headers (i.e. '
+                             'sorted by read ID, such as this script\'s own output, but not raw '
+                             'basecaller output), so each read is renamed and output immediately '
+                             'without sorting')
+    parser.add_argument('--temp_dir', type=str, required=False, default=None,
+                        help='Directory for temporary sort files (default: system temp directory)')
+
+    parser.add_argument('input_reads', type=str,
+                        help='Input reads (FASTA or FASTQ, can be gzipped)')
+    parser.add_argument('read_id_to_fast5', type=str,
+                        help='Tab-delimited file of read IDs and fast5 filenames')
+
+    args = parser.parse_args()
+    return args
 
 
 def main():
-    input_reads_filename = sys.argv[1]
-    read_id_to_fast5_filename = sys.argv[2]
+    args = get_arguments()
+    fast5_names = load_read_id_to_fast5(args.read_id_to_fast5)
+
+    print('Loading, renaming and sorting reads from ' + args.input_reads, file=sys.stderr,
+          flush=True)
+    reads, read_type = load_fasta_or_fastq(args.input_reads)
+    header_parser = HeaderParser()
+    output_reads = ((get_new_header(header, header_parser, fast5_names), seq, qual)
+                    for header, seq, qual in reads if len(seq) > 0)
+    if args.sorted_input:
+        output_reads = check_reads_sorted(output_reads)
+    else:
+        output_reads = sort_reads(output_reads, args.sort_memory, args.temp_dir)
+
+    print('Outputting reads', file=sys.stderr, flush=True)
+    with open_output(args.output, args.threads) as out:
+        for header, seq, qual in output_reads:
+            if read_type == 'FASTA':
+                out.write(b'>' + header.encode() + b'\n' + seq + b'\n')
+            else:  # read_type == 'FASTQ'
+                out.write(b'@' + header.encode() + b'\n' + seq + b'\n+\n' + qual + b'\n')
+    header_parser.print_layout_counts()
+    print('Done!\n', file=sys.stderr, flush=True)
 
+
+def load_read_id_to_fast5(read_id_to_fast5_filename):
+    """
+    Returns an object for looking up fast5 names by read ID (get_fast5) and read IDs by fast5 name
+    (get_read_id).
+    """
     print('\nReading ' + read_id_to_fast5_filename, file=sys.stderr, flush=True)
+    index = fast5_name_index.load_fast5_name_index(read_id_to_fast5_filename)
+    if index is not None:
+        return index
     read_id_to_fast5, fast5_to_read_id = {}, {}
     with open(read_id_to_fast5_filename, 'rt') as read_id_to_fast5_file:
         for line in read_id_to_fast5_file:
@@ -54,157 +132,233 @@ def main():
                     sys.exit('Error: duplicate fast5 in ' + read_id_to_fast5_filename + ': ' + fast5)
                 read_id_to_fast5[read_id] = fast5
                 fast5_to_read_id[fast5] = read_id
-
-    print('Loading reads from ' + input_reads_filename, file=sys.stderr, flush=True)
-    reads, read_type = load_fasta_or_fastq(input_reads_filename)
-
-    print('Fixing read names', file=sys.stderr, flush=True)
-    output_reads = []
-    for header, seq, qual in reads:
-        read_id, fast5_name = None, None
-        try:
-            read_id = re.search(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}', header).group(0)
-        except AttributeError:
-            read_id = None
-        try:
-            fast5_name = re.search(r'\w+_ch\d+_read\d+_\w+', header).group(0)
-        except AttributeError:
-            fast5_name = None
-        if read_id is None and fast5_name is None:
-            sys.exit('Error: could not parse read header\n' + header)
-
-        if read_id is not None:
-            new_header = read_id + ' ' + read_id_to_fast5[read_id]
-        else:
-            new_header = fast5_to_read_id[fast5_name] + ' ' + fast5_name
-
-        output_reads.append((new_header, seq, qual))
-
-    print('Sorting reads', file=sys.stderr, flush=True)
-    output_reads = sorted(output_reads)
-
-    print('Outputting reads', file=sys.stderr, flush=True)
-    for header, seq, qual in output_reads:
-        if len(seq) == 0:
-            continue
-        if read_type == 'FASTA':
-            print('>' + header)
-            print(seq)
-        else:  # read_type == 'FASTQ'
-            print('@' + header)
-            print(seq)
-            print('+')
-            print(qual)
-    print('Done!\n', file=sys.stderr, flush=True)
-
-
-def get_compression_type(filename):
-    magic_dict = {'gz': (b'\x1f', b'\x8b', b'\x08'),
-                  'bz2': (b'\x42', b'\x5a', b'\x68'),
-                  'zip': (b'\x50', b'\x4b', b'\x03', b'\x04')}
-    max_len = max(len(x) for x in magic_dict)
-
-    unknown_file = open(filename, 'rb')
-    file_start = unknown_file.read(max_len)
-    unknown_file.close()
-    compression_type = 'plain'
-    for filetype, magic_bytes in magic_dict.items():
-        if file_start.startswith(magic_bytes):
-            compression_type = filetype
-    if compression_type == 'bz2':
-        sys.exit('Error: cannot use bzip2 format - use gzip instead')
-    if compression_type == 'zip':
-        sys.exit('Error: cannot use zip format - use gzip instead')
-    return compression_type
-
-
-def get_sequence_file_type(filename):
-    if not os.path.isfile(filename):
-        sys.exit('Error: could not find ' + filename)
-    if get_compression_type(filename) == 'gz':
-        open_func = gzip.open
-    else:  # plain text
-        open_func = open
-
-    with open_func(filename, 'rt') as seq_file:
-        try:
-            first_char = seq_file.read(1)
-        except UnicodeDecodeError:
-            first_char = ''
-
-    if first_char == '>':
-        return 'FASTA'
-    elif first_char == '@':
-        return 'FASTQ'
+    return Fast5NameDicts(read_id_to_fast5, fast5_to_read_id)
+
+
+class Fast5NameDicts(object):
+    """
+    Dictionary-based lookups, for read_id_to_fast5 files which can't go in a Fast5NameIndex.
+    """
+    def __init__(self, read_id_to_fast5, fast5_to_read_id):
+        self.read_id_to_fast5 = read_id_to_fast5
+        self.fast5_to_read_id = fast5_to_read_id
+
+    def get_fast5(self, read_id):
+        return self.read_id_to_fast5[read_id]
+
+    def get_read_id(self, fast5_name):
+        return self.fast5_to_read_id[fast5_name]
+
+
+READ_ID_PATTERN = fast5_name_index.READ_ID_PATTERN
+FAST5_NAME_PATTERN = re.compile(r'\w+_ch\d+_read\d+_\w+')
+
+
+class HeaderParser(object):
+    """
+    Finds the read ID (or failing that, the fast5 name) in read headers, using patterns compiled
+    once. A read ID contains dashes, so headers without a '-' (e.g. a bare fast5 name) skip the
+    read ID search. The results are the same as searching for each pattern in the whole header.
+
+    It also counts which basecaller's layout each header had, for reporting at the end.
+    """
+    LAYOUTS = ['Guppy', 'Albacore', 'Flappie', 'Scrappie', 'Chiron', 'other with read ID',
+               'other with fast5 name']
+
+    def __init__(self):
+        self.layout_counts = collections.Counter()
+
+    def parse(self, header):
+        """
+        Returns (read ID, None) or (None, fast5 name) for the header.
+        """
+        if '-' in header:
+            match = READ_ID_PATTERN.search(header)
+            if match is not None:
+                self.layout_counts[get_read_id_layout(header, match.start())] += 1
+                return match.group(0), None
+        match = FAST5_NAME_PATTERN.search(header)
+        if match is not None:
+            self.layout_counts[get_fast5_name_layout(header, match.start(), match.end())] += 1
+            return None, match.group(0)
+        sys.exit('Error: could not parse read header\n' + header)
+
+    def print_layout_counts(self):
+        print('Read header layouts:', file=sys.stderr)
+        for layout in self.LAYOUTS:
+            print('  {}: {:,}'.format(layout, self.layout_counts[layout]), file=sys.stderr)
+
+
+def get_read_id_layout(header, read_id_start):
+    """
+    Guesses the basecaller for a header with a read ID. Guppy and Albacore 2 follow the read ID
+    with key=value tags (only Guppy's include flow_cell_id), Albacore 1 appends _Basecall_1D to it
+    and Flappie follows it with JSON.
+    """
+    if read_id_start == 0:
+        if header.startswith(' runid=', 36):
+            return 'Guppy' if 'flow_cell_id=' in header else 'Albacore'
+        if header.startswith('_Basecall_1D', 36):
+            return 'Albacore'
+        if header[36:].lstrip().startswith('{'):
+            return 'Flappie'
+    return 'other with read ID'
+
+
+def get_fast5_name_layout(header, fast5_name_start, fast5_name_end):
+    """
+    Guesses the basecaller for a header with a fast5 name but no read ID. Scrappie follows the
+    fast5 name with JSON and Chiron uses the fast5 name alone.
+    """
+    if fast5_name_start == 0:
+        rest = header[fast5_name_end:].lstrip()
+        if not rest:
+            return 'Chiron'
+        if rest.startswith('{'):
+            return 'Scrappie'
+    return 'other with fast5 name'
+
+
+def get_new_header(header, header_parser, fast5_names):
+    read_id, fast5_name = header_parser.parse(header)
+    if read_id is not None:
+        return read_id + ' ' + fast5_names.get_fast5(read_id)
+    else:
+        return fast5_names.get_read_id(fast5_name) + ' ' + fast5_name
+
+
+def check_reads_sorted(reads):
+    """
+    Passes the reads through unchanged, quitting with an error if they aren't in header order.
+    """
+    previous_header = None
+    for read in reads:
+        if previous_header is not None and read[0] < previous_header:
+            sys.exit('\nError: reads are not in order of their new headers - run without '
+                     '--sorted_input')
+        previous_header = read[0]
+        yield read
+
+
+def sort_reads(reads, sort_memory, temp_dir):
+    """
+    Sorts the (header, sequence, qualities) reads using only the header. If a memory budget (in MB)
+    is given, this is an external merge sort: sorted runs are spilled to temporary files whenever
+    the budget is reached and then merged. Otherwise the reads are sorted in memory.
+    """
+    if sort_memory is None:
+        return sorted(reads, key=get_read_header)
+    return external_sort_reads(reads, int(sort_memory * 1000000), temp_dir)
+
+
+def external_sort_reads(reads, memory_budget, temp_dir):
+    with tempfile.TemporaryDirectory(prefix='fix_read_names_', dir=temp_dir) as run_dir:
+        run, run_size, run_filenames = [], 0, []
+        for read in reads:
+            run.append(read)
+            run_size += get_read_memory_size(read)
+            if run_size >= memory_budget:
+                run.sort(key=get_read_header)
+                run_filenames.append(write_sort_run(run, run_dir, len(run_filenames)))
+                run, run_size = [], 0
+        run.sort(key=get_read_header)
+        if not run_filenames:
+            yield from run
+            return
+        print('  spilled {:,} sorted runs to {}'.format(len(run_filenames), run_dir),
+              file=sys.stderr, flush=True)
+        run_count = len(run_filenames)
+        run_filenames.append(write_sort_run(run, run_dir, run_count))
+        run = []
+
+        # Merge the runs in groups if there are too many to have open at once.
+        while len(run_filenames) > MAX_MERGE_RUNS:
+            merged_filenames = []
+            for i in range(0, len(run_filenames), MAX_MERGE_RUNS):
+                run_count += 1
+                merged_filenames.append(write_sort_run(
+                    merge_sort_runs(run_filenames[i:i+MAX_MERGE_RUNS]), run_dir, run_count))
+            run_filenames = merged_filenames
+        yield from merge_sort_runs(run_filenames)
+
+
+MAX_MERGE_RUNS = 200
+
+
+def get_read_header(read):
+    return read[0]
+
+
+def get_read_memory_size(read):
+    """
+    A rough estimate of a read's memory use: its contents plus Python object overhead.
+    """
+    header, seq, qual = read
+    return len(header) + len(seq) + len(qual) + 250
+
+
+def write_sort_run(reads, run_dir, run_num):
+    """
+    Saves sorted reads to a run file: three lines (header, sequence, qualities) per read.
+    """
+    run_filename = os.path.join(run_dir, 'run_{:06d}'.format(run_num))
+    with open(run_filename, 'wb') as run_file:
+        for header, seq, qual in reads:
+            run_file.write(header.encode() + b'\n' + seq + b'\n' + qual + b'\n')
+    return run_filename
+
+
+def iterate_sort_run(run_filename):
+    with open(run_filename, 'rb') as run_file:
+        for header in run_file:
+            seq = next(run_file)
+            qual = next(run_file)
+            yield header[:-1].decode(), seq[:-1], qual[:-1]
+    os.remove(run_filename)
+
+
+def merge_sort_runs(run_filenames):
+    return heapq.merge(*[iterate_sort_run(f) for f in run_filenames], key=get_read_header)
+
+
+@contextlib.contextmanager
+def open_output(filename, threads):
+    """
+    Yields a binary writer for the output: BGZF for .gz filenames, plain otherwise (stdout if no
+    filename is given).
+    """
+    if filename is None:
+        yield sys.stdout.buffer
+        sys.stdout.buffer.flush()
+    elif filename.endswith('.gz'):
+        with open(filename, 'wb') as out_file, seq_io.BgzfWriter(out_file, threads) as writer:
+            yield writer
     else:
-        raise ValueError('File is neither FASTA or FASTQ')
+        with open(filename, 'wb') as out_file:
+            yield out_file
 
 
 def load_fasta_or_fastq(filename):
+    """
+    Returns an iterator over the reads, along with the file type. Reads are (header, sequence,
+    qualities) tuples, with the header as a string and the sequence/qualities as bytes (qualities
+    are empty for FASTA).
+    """
+    file_type, records = seq_io.iterate_records(filename)
+    return iterate_reads(filename, file_type, records), file_type
+
+
+def iterate_reads(filename, file_type, records):
     try:
-        file_type = get_sequence_file_type(filename)
         if file_type == 'FASTA':
-            return load_fasta(filename), 'FASTA'
+            for _, header, seq in records:
+                yield bytes(header).decode(), bytes(seq), b''
         else:  # FASTQ
-            return load_fastq(filename), 'FASTQ'
+            for _, header, seq, qual in records:
+                yield bytes(header).decode(), bytes(seq), bytes(qual)
     except IndexError:
         sys.exit('\nError: ' + filename + ' could not be parsed - is it formatted correctly?')
 
 
-def load_fasta(fasta_filename):
-    if get_compression_type(fasta_filename) == 'gz':
-        open_func = gzip.open
-    else:  # plain text
-        open_func = open
-    fasta_seqs = []
-    with open_func(fasta_filename, 'rt') as fasta_file:
-        name = ''
-        sequence = ''
-        for line in fasta_file:
-            line = line.strip()
-            if not line:
-                continue
-            if line[0] == '>':  # Header line = start of new contig
-                if name:
-                    fasta_seqs.append((name, sequence, ''))
-                    sequence = ''
-                name = line[1:]
-            else:
-                sequence += line
-        if name:
-            fasta_seqs.append((name, sequence, ''))
-    return fasta_seqs
-
-
-def load_fastq(fastq_filename):
-    if get_compression_type(fastq_filename) == 'gz':
-        open_func = gzip.open
-    else:  # plain text
-        open_func = open
-    reads = []
-
-    extra_empty_line = False
-    with open_func(fastq_filename, 'rt') as fastq:
-        for line in fastq:
-            _ = next(fastq)
-            _ = next(fastq)
-            _ = next(fastq)
-            fifth_line = next(fastq).strip()
-            if len(fifth_line) == 0:
-                extra_empty_line = True
-            break
-
-    with open_func(fastq_filename, 'rt') as fastq:
-        for line in fastq:
-            name = line.strip()[1:]
-            sequence = next(fastq).strip()
-            _ = next(fastq)
-            qualities = next(fastq).strip()
-            if extra_empty_line:
-                _ = next(fastq)
-            reads.append((name, sequence, qualities))
-    return reads
-
-
 if __name__ == '__main__':
     main()
@@ -24,179 +24,335 @@ If less than half of a read aligns, it is deemed unaligned and given an identity
 half aligns, only the aligned parts are used to determined the read identity.
 
 Relative length is included to see if the reads are systematically too short or too long.
+
+With --streaming, the reads and the PAF are read in lockstep and each row is output as soon as its
+read is done, so memory use doesn't grow with the read set. This requires the reads to be sorted by
+name and the PAF to have each read's alignments grouped together in the same order as the reads
+(which is how minimap2 outputs them). The PAF can then come straight from minimap2 on stdin:
+  minimap2 -x map-ont -c reference.fasta reads.fastq.gz | read_length_identity.py --streaming reads.fastq.gz -
+
+With --threads, the identity calculations are spread over multiple processes. Reads are sent to the
+worker processes in chunks and the output is written in the same order as with one thread. The
+reads and PAF are still parsed in the main process, so check the gain on your machine with
+benchmark_read_length_identity.py before using it.
+
+Read lengths come from a length index (see seq_index.py) which is saved next to the read file, so
+later runs on the same reads don't have to parse them again. With --streaming, an up-to-date index
+is used if there is one, otherwise the reads are parsed as they stream past and the index is saved
+at the end (this holds the read names in memory, but not the alignments).
 """
 
 
+import argparse
+import array
 import collections
-import gzip
+import fractions
+import heapq
+import multiprocessing
 import os
-import statistics
 import sys
 
+import seq_index
+import seq_io
 
-def main():
-    read_filename = sys.argv[1]
-    paf_filename = sys.argv[2]
 
-    read_lengths = get_read_lengths(read_filename)
-    read_names = sorted(read_lengths.keys())
-    read_alignments = load_alignments(paf_filename, read_lengths)
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Produce a table of read lengths and identities')
 
-    print('\t'.join(['Name', 'Length', 'Identity', 'Relative length']))
-    for read_num, read_name in enumerate(read_names):
-        read_length = read_lengths[read_name]
-        alignments = read_alignments[read_name]
-        identity_by_base = [0.0] * read_length
-        total_read_length, total_ref_length = 0, 0
-
-        for read_start, read_end, ref_start, ref_end, identity in alignments:
-            for i in range(read_start, read_end):
-                if identity > identity_by_base[i]:
-                    identity_by_base[i] = identity
-            total_read_length += read_end - read_start
-            total_ref_length += ref_end - ref_start
-
-        # If less than half the read aligned, then we call it an unaligned read.
-        if identity_by_base.count(0.0) > read_length / 2.0:
-            whole_read_identity = 0.0
-
-        # Otherwise, the read's identity is the average of the aligned parts.
-        else:
-            whole_read_identity = statistics.mean([x for x in identity_by_base if x > 0.0])
+    parser.add_argument('--streaming', action='store_true',
+                        help='Process reads and alignments in lockstep (reads must be sorted by '
+                             'name and the PAF grouped by read in the same order)')
+    parser.add_argument('--threads', type=int, required=False, default=1,
+                        help='Number of processes to use for the identity calculations')
+    parser.add_argument('--no_index', action='store_true',
+                        help='Do not save a length index file next to the reads')
 
-        if whole_read_identity > 0.0:
-            relative_length = '%.5f' % (100.0 * total_read_length / total_ref_length)
+    parser.add_argument('reads', type=str,
+                        help='Reads (FASTA or FASTQ, can be gzipped)')
+    parser.add_argument('paf', type=str,
+                        help='minimap2 PAF alignment of the reads (use - for stdin)')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = get_arguments()
+    if args.paf == '-':
+        paf = sys.stdin
+    else:
+        paf = open(args.paf, 'rt')
+    with paf:
+        if args.streaming:
+            process_reads_streaming(args.reads, paf, args.threads, not args.no_index)
         else:
-            relative_length = ''
+            process_reads(args.reads, paf, args.threads, not args.no_index)
+
+
+def process_reads(read_filename, paf, threads, write_index):
+    read_lengths = get_read_lengths(read_filename, write_index)
+    read_names = sorted(read_lengths.keys())
+    read_alignments = load_alignments(paf, read_lengths)
+    reads = ((read_name, read_lengths[read_name], read_alignments[read_name])
+             for read_name in read_names)
 
-        print('{}\t{}\t{:.5f}\t{}'.format(read_name, read_length, whole_read_identity, relative_length))
+    print_header()
+    for read_num, row in enumerate(iterate_read_rows(reads, threads)):
+        print(row)
         print_progress(read_num, len(read_names))
     print('\n', file=sys.stderr)
 
 
+def process_reads_streaming(read_filename, paf, threads, write_index):
+    reads = iterate_streaming_reads(read_filename, paf, write_index)
+
+    print_header()
+    read_num = -1
+    for read_num, row in enumerate(iterate_read_rows(reads, threads)):
+        print(row)
+        print_streaming_progress(read_num)
+    print_streaming_progress(read_num)
+    print('\n', file=sys.stderr)
+
+
+def iterate_streaming_reads(read_filename, paf, write_index):
+    """
+    Walks through the reads and the PAF together like a merge join, so only one read's alignments
+    are held in memory at once. Yields (read name, read length, alignments) for each read.
+    """
+    alignment_groups = iterate_alignment_groups(paf)
+    next_group = next(alignment_groups, None)
+    previous_read_name = None
+
+    for read_name, read_length in iterate_read_lengths(read_filename, write_index):
+        if previous_read_name is not None and read_name <= previous_read_name:
+            sys.exit('\nError: reads must be sorted by name when using --streaming')
+        previous_read_name = read_name
+        if next_group is not None and next_group[0] < read_name:
+            sys.exit('\nError: PAF is not grouped in the same order as the reads '
+                     '(at ' + next_group[0] + ')')
+
+        alignments = []
+        if next_group is not None and next_group[0] == read_name:
+            for alignment_read_length, alignment in next_group[1]:
+                assert alignment_read_length == read_length
+                alignments.append(alignment)
+            next_group = next(alignment_groups, None)
+        yield read_name, read_length, alignments
+
+    if next_group is not None:
+        sys.exit('\nError: PAF read is missing from the read file or out of order: ' +
+                 next_group[0])
+
+
+READS_PER_CHUNK = 1000
+
+
+def iterate_read_rows(reads, threads):
+    """
+    Yields the output row for each (read name, read length, alignments) in reads, keeping the
+    input order. With more than one thread, chunks of reads are processed in a pool of worker
+    processes. Only a limited number of chunks are in flight at once, so this doesn't pull the
+    whole input into memory.
+    """
+    if threads <= 1:
+        for read in reads:
+            yield get_read_row(read)
+        return
+    pool = multiprocessing.Pool(threads)
+    try:
+        pending_chunks = collections.deque()
+        for chunk in iterate_chunks(reads, READS_PER_CHUNK):
+            pending_chunks.append(pool.apply_async(get_read_rows, (chunk,)))
+            if len(pending_chunks) >= threads * 2:
+                yield from pending_chunks.popleft().get()
+        while pending_chunks:
+            yield from pending_chunks.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def iterate_chunks(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def print_header():
+    print('\t'.join(['Name', 'Length', 'Identity', 'Relative length']))
+
+
+def get_read_rows(reads):
+    return [get_read_row(read) for read in reads]
+
+
+def get_read_row(read):
+    read_name, read_length, alignments = read
+    whole_read_identity, relative_length = get_read_identity(read_length, alignments)
+    return '{}\t{}\t{:.5f}\t{}'.format(read_name, read_length, whole_read_identity,
+                                         relative_length)
+
+
+def get_read_identity(read_length, alignments):
+    """
+    Returns the read's identity and its relative length (as a formatted string, empty for
+    unaligned reads).
+    """
+    total_read_length = sum(read_end - read_start for read_start, read_end, _, _, _ in alignments)
+    total_ref_length = sum(ref_end - ref_start for _, _, ref_start, ref_end, _ in alignments)
+    identity_coverage = get_identity_coverage(alignments)
+    aligned_base_count = sum(identity_coverage.values())
+
+    # If less than half the read aligned, then we call it an unaligned read.
+    if read_length - aligned_base_count > read_length / 2.0:
+        whole_read_identity = 0.0
+
+    # Otherwise, the read's identity is the average of the aligned parts. This is done with exact
+    # fractions (like statistics.mean does) so the result matches a per-base average exactly.
+    else:
+        total_identity = sum(fractions.Fraction(identity) * count
+                             for identity, count in identity_coverage.items())
+        whole_read_identity = float(total_identity / aligned_base_count)
+
+    if whole_read_identity > 0.0:
+        relative_length = '%.5f' % (100.0 * total_read_length / total_ref_length)
+    else:
+        relative_length = ''
+    return whole_read_identity, relative_length
+
+
+def get_identity_coverage(alignments):
+    """
+    Each base of the read takes the identity of the best alignment covering it. This function
+    returns a dictionary of identity -> number of read bases with that identity (bases with no
+    alignment are not included).
+
+    It uses a sweep line over the alignment boundaries, keeping the covering alignments in a heap,
+    so the cost depends on the number of alignments, not the length of the read.
+    """
+    intervals = sorted((read_start, read_end, identity)
+                       for read_start, read_end, _, _, identity in alignments
+                       if read_end > read_start and identity > 0.0)
+    boundaries = sorted(set(pos for read_start, read_end, _ in intervals
+                            for pos in (read_start, read_end)))
+    identity_coverage = collections.defaultdict(int)
+    covering = []  # heap of (-identity, read_end)
+    next_interval = 0
+    for segment_start, segment_end in zip(boundaries, boundaries[1:]):
+        while next_interval < len(intervals) and intervals[next_interval][0] <= segment_start:
+            _, read_end, identity = intervals[next_interval]
+            heapq.heappush(covering, (-identity, read_end))
+            next_interval += 1
+        while covering and covering[0][1] <= segment_start:
+            heapq.heappop(covering)
+        if covering:
+            identity_coverage[-covering[0][0]] += segment_end - segment_start
+    return identity_coverage
+
+
 def print_progress(done_count, total_count):
     print('\r{:,} / {:,} reads complete'.format(done_count+1, total_count),
           end='', flush=True, file=sys.stderr)
 
 
-def load_alignments(paf_filename, read_lengths):
+def print_streaming_progress(done_count):
+    if (done_count + 1) % 1000 == 0 or done_count < 0:
+        print('\r{:,} reads complete'.format(max(done_count+1, 0)),
+              end='', flush=True, file=sys.stderr)
+
+
+def load_alignments(paf, read_lengths):
     print('Loading alignments...', end='', flush=True, file=sys.stderr)
     read_alignments = collections.defaultdict(list)
-    with open(paf_filename, 'rt') as paf:
-        for line in paf:
-            paf_parts = line.strip().split('\t')
-            if len(paf_parts) < 11:
-                continue
-            read_name = paf_parts[0]
-            read_length = int(paf_parts[1])
-            assert read_length == read_lengths[read_name]
-            read_start = int(paf_parts[2])
-            read_end = int(paf_parts[3])
-            ref_start = int(paf_parts[7])
-            ref_end = int(paf_parts[8])
-            identity = 100.0 * int(paf_parts[9]) / int(paf_parts[10])
-            read_alignments[read_name].append((read_start, read_end, ref_start, ref_end, identity))
+    for line in paf:
+        paf_alignment = parse_paf_line(line)
+        if paf_alignment is None:
+            continue
+        read_name, read_length, alignment = paf_alignment
+        assert read_length == read_lengths[read_name]
+        read_alignments[read_name].append(alignment)
     print(' done', file=sys.stderr)
     return read_alignments
 
 
-def get_compression_type(filename):
+def iterate_alignment_groups(paf):
     """
-    Attempts to guess the compression (if any) on a file using the first few bytes.
-    http://stackoverflow.com/questions/13044562
+    Yields (read name, alignments) for each run of consecutive PAF lines with the same read name.
+    Each alignment is a (read length, alignment tuple) pair.
     """
-    magic_dict = {'gz': (b'\x1f', b'\x8b', b'\x08'),
-                  'bz2': (b'\x42', b'\x5a', b'\x68'),
-                  'zip': (b'\x50', b'\x4b', b'\x03', b'\x04')}
-    max_len = max(len(x) for x in magic_dict)
-
-    unknown_file = open(filename, 'rb')
-    file_start = unknown_file.read(max_len)
-    unknown_file.close()
-    compression_type = 'plain'
-    for filetype, magic_bytes in magic_dict.items():
-        if file_start.startswith(magic_bytes):
-            compression_type = filetype
-    if compression_type == 'bz2':
-        sys.exit('Error: cannot use bzip2 format - use gzip instead')
-    if compression_type == 'zip':
-        sys.exit('Error: cannot use zip format - use gzip instead')
-    return compression_type
-
-
-def get_sequence_file_type(filename):
-    if not os.path.isfile(filename):
-        sys.exit('Error: could not find ' + filename)
-    if get_compression_type(filename) == 'gz':
-        open_func = gzip.open
-    else:  # plain text
-        open_func = open
-    with open_func(filename, 'rt') as seq_file:
-        try:
-            first_char = seq_file.read(1)
-        except UnicodeDecodeError:
-            first_char = ''
-    if first_char == '>':
-        return 'FASTA'
-    elif first_char == '@':
-        return 'FASTQ'
-    else:
-        raise ValueError('File is neither FASTA or FASTQ')
-
-
-def get_read_lengths(filename):
+    group_name, group = None, []
+    for line in paf:
+        paf_alignment = parse_paf_line(line)
+        if paf_alignment is None:
+            continue
+        read_name, read_length, alignment = paf_alignment
+        if read_name != group_name:
+            if group:
+                yield group_name, group
+            group_name, group = read_name, []
+        group.append((read_length, alignment))
+    if group:
+        yield group_name, group
+
+
+def parse_paf_line(line):
+    paf_parts = line.strip().split('\t')
+    if len(paf_parts) < 11:
+        return None
+    read_name = paf_parts[0]
+    read_length = int(paf_parts[1])
+    read_start = int(paf_parts[2])
+    read_end = int(paf_parts[3])
+    ref_start = int(paf_parts[7])
+    ref_end = int(paf_parts[8])
+    identity = 100.0 * int(paf_parts[9]) / int(paf_parts[10])
+    return read_name, read_length, (read_start, read_end, ref_start, ref_end, identity)
+
+
+def get_read_lengths(filename, write_index=True):
     print('Loading read lengths...', end='', flush=True, file=sys.stderr)
     try:
-        file_type = get_sequence_file_type(filename)
-        if file_type == 'FASTA':
-            return get_fasta_lengths(filename)
-        else:  # FASTQ
-            return get_fastq_lengths(filename)
+        names, lengths, _ = seq_index.load_index(filename, write_index)
     except IndexError:
         sys.exit('\nError: ' + filename + ' could not be parsed - is it formatted correctly?')
-
-
-def get_fasta_lengths(fasta_filename):
-    if get_compression_type(fasta_filename) == 'gz':
-        open_func = gzip.open
-    else:  # plain text
-        open_func = open
-    read_lengths = {}
-    with open_func(fasta_filename, 'rt') as fasta_file:
-        name = ''
-        sequence = []
-        for line in fasta_file:
-            line = line.strip()
-            if not line:
-                continue
-            if line[0] == '>':  # Header line = start of new contig
-                if name:
-                    read_lengths[name.split()[0]] = len(''.join(sequence))
-                    sequence = []
-                name = line[1:]
-            else:
-                sequence.append(line)
-        if name:
-            read_lengths[name.split()[0]] = len(''.join(sequence))
+    read_lengths = dict(zip(names, lengths))
     print(' done', file=sys.stderr)
     return read_lengths
 
 
-def get_fastq_lengths(fastq_filename):
-    if get_compression_type(fastq_filename) == 'gz':
-        open_func = gzip.open
-    else:  # plain text
-        open_func = open
-    read_lengths = {}
-    with open_func(fastq_filename, 'rt') as fastq:
-        for line in fastq:
-            name = line.strip()[1:].split()[0]
-            sequence = next(fastq).strip()
-            next(fastq)
-            next(fastq)
-            read_lengths[name] = len(sequence)
-    print(' done', file=sys.stderr)
-    return read_lengths
+def iterate_read_lengths(filename, write_index=True):
+    """
+    Yields (name, length) for each read in file order. These come from the length index if it is up
+    to date. Otherwise the reads are parsed, and the index is saved once they have all been seen.
+    """
+    if not os.path.isfile(filename):
+        sys.exit('\nError: could not find ' + filename)
+    stamp = seq_index.get_file_stamp(filename)
+    index_filename = seq_index.get_index_filename(filename)
+    index = seq_index.read_index_file(index_filename, stamp)
+    if index is not None:
+        names, lengths, _ = index
+        yield from zip(names, lengths)
+        return
+    names, lengths, offsets = [], array.array('Q'), array.array('Q')
+    try:
+        _, records = seq_io.iterate_records(filename)
+        for record in records:
+            name, length = seq_io.get_name(record[1]), len(record[2])
+            names.append(name)
+            lengths.append(length)
+            offsets.append(record[0])
+            yield name, length
+    except IndexError:
+        sys.exit('\nError: ' + filename + ' could not be parsed - is it formatted correctly?')
+    if write_index:
+        seq_index.write_index_file(index_filename, stamp, (names, lengths, offsets))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+"""
+Copyright 2019 Ryan Wick (rrwick@gmail.com)
+https://github.com/rrwick/Basecalling-comparison
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. This program is distributed in the hope that it
+will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details. You should
+have received a copy of the GNU General Public License along with this program. If not, see
+<http://www.gnu.org/licenses/>.
+
+This module stores the contigs of a FASTA file (gzipped or not) in a packed binary file which is
+memory-mapped, so sequences (or parts of them) are decoded on demand instead of the whole file
+being loaded into strings.
+
+Bases are packed at 2 bits each (A=0, C=1, G=2, T=3, four per byte). Anything else (N, IUPAC codes,
+gaps) is stored as a run of a repeated character which overwrites the packed bases, and lowercase
+stretches are stored as runs too, so sequences come back exactly as they were in the FASTA.
+
+The packed file is saved next to the FASTA (with a .refstore extension) and is keyed on the FASTA's
+size and modification time, so later runs just map it into memory. Building the packed file takes
+longer than a plain load of the FASTA, so for FASTA files which are only read once, use cache=False
+to load the contigs into memory instead (with the same interface).
+
+Packed file layout (little-endian):
+  * 8-byte magic
+  * header: FASTA size, FASTA mtime (ns), contig count, headers length (4 x 8 bytes)
+  * headers: newline-separated FASTA header lines (without the '>')
+  * contig table: for each contig, its length, packed data offset, first exception run, exception
+    run count, first lowercase run and lowercase run count (6 x 8 bytes)
+  * exception run count and lowercase run count (2 x 8 bytes)
+  * exception runs: starts (8 bytes each), lengths (8 bytes each), then characters (1 byte each)
+  * lowercase runs: starts (8 bytes each), then lengths (8 bytes each)
+  * packed bases
+"""
+
+import array
+import bisect
+import mmap
+import os
+import re
+import struct
+import sys
+
+import seq_index
+import seq_io
+import sequence_utils
+
+
+STORE_EXTENSION = '.refstore'
+STORE_MAGIC = b'REFSTOR\x01'
+STORE_HEADER = struct.Struct('<QqQQ')
+CONTIG_RECORD = struct.Struct('<QQQQQQ')
+RUN_COUNTS = struct.Struct('<QQ')
+PACK_BLOCK_SIZE = 1 << 20  # bases, must be a multiple of 4
+
+PACK_TABLE = bytes(b'ACGTacgt'.find(i) % 4 if i in b'ACGTacgt' else 0 for i in range(256))
+UNPACK_TABLES = [bytes(b'ACGT'[(i >> shift) & 3] for i in range(256)) for shift in (6, 4, 2, 0)]
+EXCEPTION_PATTERN = re.compile(rb'([^ACGTacgt])\1*')
+LOWERCASE_PATTERN = re.compile(rb'[a-z]+')
+
+
+def load_reference_store(fasta_filename, cache=True):
+    """
+    Returns a ReferenceStore for the FASTA file, using (or making) the cached packed file if cache
+    is True. Otherwise (or if the packed file can't be written), returns an InMemoryStore.
+    """
+    if not os.path.isfile(fasta_filename):
+        sys.exit('Error: could not find ' + fasta_filename)
+    if not cache:
+        return InMemoryStore(fasta_filename)
+    stamp = seq_index.get_file_stamp(fasta_filename)
+    store_filename = fasta_filename + STORE_EXTENSION
+    try:
+        with open(store_filename, 'rb') as store_file:
+            store = ReferenceStore(store_file)
+        if store.stamp == stamp:
+            return store
+    except (OSError, ValueError):
+        pass
+
+    contigs = load_contigs(fasta_filename)
+    temp_filename = store_filename + '.temp'
+    try:
+        with open(temp_filename, 'wb') as store_file:
+            write_store(store_file, stamp, contigs)
+        os.replace(temp_filename, store_filename)
+        with open(store_filename, 'rb') as store_file:
+            return ReferenceStore(store_file)
+    except OSError as e:
+        print('Warning: could not write {} ({})'.format(store_filename, e.strerror),
+              file=sys.stderr)
+    return InMemoryStore(fasta_filename)
+
+
+def load_contigs(fasta_filename):
+    """
+    Returns a list of (header, length, packed bases, exception runs, lowercase runs) for each
+    contig in the FASTA file.
+    """
+    return [(header, len(seq), pack_sequence(seq), get_exception_runs(seq),
+             get_lowercase_runs(seq)) for header, seq in iterate_fasta(fasta_filename)]
+
+
+def iterate_fasta(fasta_filename):
+    """
+    Yields (header, sequence as bytes) for each contig in the FASTA file.
+    """
+    try:
+        file_type, records = seq_io.iterate_records(fasta_filename)
+        if file_type != 'FASTA':
+            sys.exit('Error: ' + fasta_filename + ' is not a FASTA file')
+        for _, header, seq in records:
+            yield bytes(header).decode(), bytes(seq)
+    except (IndexError, ValueError):
+        sys.exit('Error: ' + fasta_filename + ' could not be parsed - is it formatted correctly?')
+
+
+def pack_sequence(seq):
+    """
+    Packs a sequence at 2 bits per base. The sequence is converted to one code (0-3) per byte, and
+    the codes are then squeezed together using a big integer: each step ORs every lane with a
+    shifted copy of itself and masks off the rest, halving the number of lanes. This does all the
+    work in C, rather than looping over the bases in Python. It's done in blocks so the masks can
+    be reused.
+    """
+    codes = seq.translate(PACK_TABLE) + bytes(-len(seq) % 4)
+    return b''.join(pack_codes(codes[i:i + PACK_BLOCK_SIZE])
+                    for i in range(0, len(codes), PACK_BLOCK_SIZE))
+
+
+def pack_codes(codes):
+    code_count = len(codes)
+    if code_count == PACK_BLOCK_SIZE:
+        mask_1, mask_2 = PACK_BLOCK_MASKS
+    else:
+        mask_1, mask_2 = get_pack_masks(code_count)
+    packed = int.from_bytes(codes, 'big')
+    packed = (packed | (packed >> 6)) & mask_1
+    packed = (packed | (packed >> 12)) & mask_2
+    return packed.to_bytes(code_count, 'big')[3::4]
+
+
+def get_pack_masks(code_count):
+    return (int.from_bytes(b'\x00\x0f' * (code_count // 2), 'big'),
+            int.from_bytes(b'\x00\x00\x00\xff' * (code_count // 4), 'big'))
+
+
+PACK_BLOCK_MASKS = get_pack_masks(PACK_BLOCK_SIZE)
+
+
+def unpack_sequence(packed):
+    """
+    Returns the bases (as a bytearray, four per packed byte) for packed data.
+    """
+    seq = bytearray(len(packed) * 4)
+    for i, table in enumerate(UNPACK_TABLES):
+        seq[i::4] = packed.translate(table)
+    return seq
+
+
+def get_exception_runs(seq):
+    if not seq.translate(None, b'ACGTacgt'):  # quick check, as most sequences have no exceptions
+        return []
+    return [(m.start(), m.end() - m.start(), seq[m.start():m.start() + 1].upper())
+            for m in EXCEPTION_PATTERN.finditer(seq)]
+
+
+def get_lowercase_runs(seq):
+    if seq == seq.upper():
+        return []
+    return [(m.start(), m.end() - m.start()) for m in LOWERCASE_PATTERN.finditer(seq)]
+
+
+def write_uint_array(store_file, values):
+    values = array.array('Q', values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    values.tofile(store_file)
+
+
+def write_store(store_file, stamp, contigs):
+    headers = '\n'.join(contig[0] for contig in contigs).encode()
+    store_file.write(STORE_MAGIC)
+    store_file.write(STORE_HEADER.pack(stamp[0], stamp[1], len(contigs), len(headers)))
+    store_file.write(headers)
+
+    packed_offset, exception_count, lowercase_count = 0, 0, 0
+    for _, length, packed, exception_runs, lowercase_runs in contigs:
+        store_file.write(CONTIG_RECORD.pack(length, packed_offset,
+                                            exception_count, len(exception_runs),
+                                            lowercase_count, len(lowercase_runs)))
+        packed_offset += len(packed)
+        exception_count += len(exception_runs)
+        lowercase_count += len(lowercase_runs)
+    store_file.write(RUN_COUNTS.pack(exception_count, lowercase_count))
+
+    exception_runs = [run for contig in contigs for run in contig[3]]
+    lowercase_runs = [run for contig in contigs for run in contig[4]]
+    write_uint_array(store_file, (start for start, _, _ in exception_runs))
+    write_uint_array(store_file, (length for _, length, _ in exception_runs))
+    store_file.write(b''.join(char for _, _, char in exception_runs))
+    write_uint_array(store_file, (start for start, _ in lowercase_runs))
+    write_uint_array(store_file, (length for _, length in lowercase_runs))
+    for contig in contigs:
+        store_file.write(contig[2])
+
+
+class ReferenceStore(object):
+    """
+    A read-only view of a packed file. Contigs are looked up by name (the first word of the
+    header), and get_sequence returns a contig's sequence (or a slice of it) as a string.
+    """
+    def __init__(self, store_file):
+        self.data = mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(STORE_MAGIC)] != STORE_MAGIC:
+            raise ValueError('not a reference store')
+        pos = len(STORE_MAGIC)
+        size, mtime, contig_count, headers_size = STORE_HEADER.unpack_from(self.data, pos)
+        self.stamp = (size, mtime)
+        pos += STORE_HEADER.size
+
+        self.headers = self.data[pos:pos + headers_size].decode().split('\n') \
+            if contig_count > 0 else []
+        self.names = [header.split()[0] if header.split() else '' for header in self.headers]
+        self.name_to_index = {name: i for i, name in enumerate(self.names)}
+        pos += headers_size
+
+        self.contigs = []
+        for _ in range(contig_count):
+            self.contigs.append(CONTIG_RECORD.unpack_from(self.data, pos))
+            pos += CONTIG_RECORD.size
+        exception_count, lowercase_count = RUN_COUNTS.unpack_from(self.data, pos)
+        pos += RUN_COUNTS.size
+
+        self.exception_starts, pos = self.read_uint_array(pos, exception_count)
+        self.exception_lengths, pos = self.read_uint_array(pos, exception_count)
+        self.exception_chars = self.data[pos:pos + exception_count]
+        pos += exception_count
+        self.lowercase_starts, pos = self.read_uint_array(pos, lowercase_count)
+        self.lowercase_lengths, pos = self.read_uint_array(pos, lowercase_count)
+        self.packed_start = pos
+        if len(self.data) < pos + sum((contig[0] + 3) // 4 for contig in self.contigs):
+            raise ValueError('truncated reference store')
+
+    def read_uint_array(self, pos, count):
+        values = array.array('Q')
+        values.frombytes(self.data[pos:pos + 8 * count])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values, pos + 8 * count
+
+    def __len__(self):
+        return len(self.contigs)
+
+    def __contains__(self, name):
+        return name in self.name_to_index
+
+    def get_index(self, name):
+        try:
+            return self.name_to_index[name]
+        except KeyError:
+            raise KeyError(name)
+
+    def get_length(self, name):
+        return self.contigs[self.get_index(name)][0]
+
+    def get_sequence(self, name, start=0, end=None):
+        """
+        Returns the contig's sequence from start to end (like slicing a string, but negative
+        positions aren't supported).
+        """
+        return self.get_sequence_bytes(name, start, end).decode()
+
+    def get_sequence_bytes(self, name, start=0, end=None):
+        """
+        Like get_sequence, but returns the sequence as a bytearray.
+        """
+        length, packed_offset, first_exception, exception_count, first_lowercase, \
+            lowercase_count = self.contigs[self.get_index(name)]
+        end = length if end is None else min(end, length)
+        start = min(start, end)
+
+        packed_first = start // 4
+        packed_last = (end + 3) // 4
+        packed = self.data[self.packed_start + packed_offset + packed_first:
+                           self.packed_start + packed_offset + packed_last]
+        seq = unpack_sequence(packed)
+        shift = packed_first * 4
+        del seq[end - shift:]
+        del seq[:start - shift]
+
+        for i in self.get_overlapping_runs(self.exception_starts, self.exception_lengths,
+                                           first_exception, exception_count, start, end):
+            run_start = max(self.exception_starts[i], start)
+            run_end = min(self.exception_starts[i] + self.exception_lengths[i], end)
+            seq[run_start - start:run_end - start] = \
+                self.exception_chars[i:i + 1] * (run_end - run_start)
+        for i in self.get_overlapping_runs(self.lowercase_starts, self.lowercase_lengths,
+                                           first_lowercase, lowercase_count, start, end):
+            run_start = max(self.lowercase_starts[i], start)
+            run_end = min(self.lowercase_starts[i] + self.lowercase_lengths[i], end)
+            seq[run_start - start:run_end - start] = seq[run_start - start:run_end - start].lower()
+        return seq
+
+    def get_circular_sequence(self, name):
+        return CircularSequence(self, name)
+
+    @staticmethod
+    def get_overlapping_runs(starts, lengths, first, count, start, end):
+        """
+        Returns the indices of a contig's runs which overlap start to end. The runs are sorted and
+        don't overlap each other, so this is a binary search and a scan.
+        """
+        i = bisect.bisect_right(starts, start, first, first + count) - 1
+        if i < first or starts[i] + lengths[i] <= start:
+            i += 1
+        indices = []
+        while i < first + count and starts[i] < end:
+            indices.append(i)
+            i += 1
+        return indices
+
+    def iterate_contigs(self):
+        """
+        Yields (name, length, header) for each contig, in FASTA order.
+        """
+        for name, header, contig in zip(self.names, self.headers, self.contigs):
+            yield name, contig[0], header
+
+
+class InMemoryStore(ReferenceStore):
+    """
+    The same interface as ReferenceStore, but with each contig's sequence loaded into memory as
+    bytes, for FASTA files which aren't worth packing.
+    """
+    def __init__(self, fasta_filename):
+        self.stamp = seq_index.get_file_stamp(fasta_filename)
+        self.headers, self.seqs = [], []
+        for header, seq in iterate_fasta(fasta_filename):
+            self.headers.append(header)
+            self.seqs.append(seq)
+        self.names = [header.split()[0] if header.split() else '' for header in self.headers]
+        self.name_to_index = {name: i for i, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.seqs)
+
+    def get_length(self, name):
+        return len(self.seqs[self.get_index(name)])
+
+    def get_sequence_bytes(self, name, start=0, end=None):
+        """
+        Like get_sequence, but returns the sequence as bytes.
+        """
+        return self.seqs[self.get_index(name)][start:end]
+
+    def iterate_contigs(self):
+        for name, header, seq in zip(self.names, self.headers, self.seqs):
+            yield name, len(seq), header
+
+
+class CircularSequence(object):
+    """
+    A view of a circular contig in a reference store, optionally reverse complemented and/or
+    rotated to a new starting position. Slices can run past the end of the contig (wrapping around
+    to its start), and nothing is copied until a slice is taken, so a rotated contig can be written
+    out in pieces without ever building the whole rotated sequence.
+    """
+    def __init__(self, store, name, offset=0, reverse=False):
+        self.store = store
+        self.name = name
+        self.length = store.get_length(name)
+        self.offset = offset % self.length if self.length > 0 else 0
+        self.reverse = reverse
+
+    def __len__(self):
+        return self.length
+
+    def rotated(self, start_pos):
+        """
+        Returns a view of this sequence which starts at start_pos.
+        """
+        return CircularSequence(self.store, self.name, self.offset + start_pos, self.reverse)
+
+    def reverse_complemented(self):
+        """
+        Returns a view of this sequence's reverse complement. Reversing the rotated sequence
+        S[o:] + S[:o] gives rc(S)[L-o:] + rc(S)[:L-o], i.e. rc(S) rotated by L-o.
+        """
+        return CircularSequence(self.store, self.name, self.length - self.offset,
+                                not self.reverse)
+
+    def get_slice(self, start, end):
+        """
+        Returns the sequence (as bytes) from start to end. Positions are taken modulo the length,
+        so end can go past the end of the sequence (wrapping around), but end must not be less
+        than start.
+        """
+        return b''.join(self.iterate_pieces(start, end))
+
+    def iterate_pieces(self, start, end, piece_size=PACK_BLOCK_SIZE):
+        """
+        Yields the sequence from start to end (as in get_slice) in pieces of at most piece_size.
+        """
+        assert end >= start
+        if self.length == 0:
+            return
+        remaining = end - start
+        pos = (self.offset + start) % self.length
+        while remaining > 0:
+            piece_length = min(remaining, self.length - pos, piece_size)
+            yield self.get_unrotated(pos, pos + piece_length)
+            remaining -= piece_length
+            pos = (pos + piece_length) % self.length
+
+    def get_unrotated(self, start, end):
+        if not self.reverse:
+            return self.store.get_sequence_bytes(self.name, start, end)
+        return sequence_utils.reverse_complement(
+            self.store.get_sequence_bytes(self.name, self.length - end, self.length - start))
+
+    def write(self, out, start=0, end=None):
+        """
+        Writes the sequence from start to end (the whole sequence by default) to a binary file.
+        """
+        if end is None:
+            end = start + self.length
+        for piece in self.iterate_pieces(start, end):
+            out.write(piece)
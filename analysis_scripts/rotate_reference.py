@@ -19,62 +19,33 @@ assembly (with a new starting point).
 import random
 import sys
 
-
-def main():
-    ref = load_fasta(sys.argv[1])
-    random.seed(int(sys.argv[2]))
-    assert len(ref) == 1
-    ref_seq = ref[0][1]
-    assert len(ref_seq) > 1000000
-    if random.random() < 0.5:
-        ref_seq = reverse_complement(ref_seq)
-    new_start_pos = random.randint(0, len(ref_seq) - 1)
-    ref_seq = ref_seq[new_start_pos:] + ref_seq[:new_start_pos]
-    print('>reference circular=true')
-    print(ref_seq)
-
-
-def load_fasta(fasta_filename):
-    fasta_seqs = []
-    with open(fasta_filename, 'rt') as fasta_file:
-        name = ''
-        sequence = []
-        for line in fasta_file:
-            line = line.strip()
-            if not line:
-                continue
-            if line[0] == '>':  # Header line = start of new contig
-                if name:
-                    fasta_seqs.append((name.split()[0], ''.join(sequence), name))
-                    sequence = []
-                name = line[1:]
-            else:
-                sequence.append(line)
-        if name:
-            fasta_seqs.append((name.split()[0], ''.join(sequence), name))
-    return fasta_seqs
+import reference_store
 
 
-REV_COMP_DICT = {'A': 'T', 'T': 'A', 'G': 'C', 'C': 'G',
-                 'a': 't', 't': 'a', 'g': 'c', 'c': 'g',
-                 'R': 'Y', 'Y': 'R', 'S': 'S', 'W': 'W',
-                 'K': 'M', 'M': 'K', 'B': 'V', 'V': 'B',
-                 'D': 'H', 'H': 'D', 'N': 'N',
-                 'r': 'y', 'y': 'r', 's': 's', 'w': 'w',
-                 'k': 'm', 'm': 'k', 'b': 'v', 'v': 'b',
-                 'd': 'h', 'h': 'd', 'n': 'n',
-                 '.': '.', '-': '-', '?': '?'}
-
-
-def complement_base(base):
-    try:
-        return REV_COMP_DICT[base]
-    except KeyError:
-        return 'N'
+def main():
+    ref = reference_store.load_reference_store(sys.argv[1])
+    write_rotated_reference(ref, int(sys.argv[2]), sys.stdout.buffer)
 
 
-def reverse_complement(seq):
-    return ''.join([complement_base(x) for x in seq][::-1])
+def write_rotated_reference(ref, seed, out):
+    """
+    Writes a randomly rotated (and possibly reverse complemented) copy of a one-contig reference
+    store to a binary file, as FASTA.
+    """
+    rng = random.Random(seed)
+    assert len(ref) == 1
+    ref_seq = ref.get_circular_sequence(ref.names[0])
+    assert len(ref_seq) > 1000000
+    if rng.random() < 0.5:
+        ref_seq = ref_seq.reverse_complemented()
+    new_start_pos = rng.randint(0, len(ref_seq) - 1)
+    ref_seq = ref_seq.rotated(new_start_pos)
+
+    # The rotated sequence is written in pieces straight to the file, so it is never built in full.
+    out.write(b'>reference circular=true\n')
+    ref_seq.write(out)
+    out.write(b'\n')
+    out.flush()
 
 
 if __name__ == '__main__':
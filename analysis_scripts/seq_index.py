@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Copyright 2019 Ryan Wick (rrwick@gmail.com)
+https://github.com/rrwick/Basecalling-comparison
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. This program is distributed in the hope that it
+will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details. You should
+have received a copy of the GNU General Public License along with this program. If not, see
+<http://www.gnu.org/licenses/>.
+
+This module makes and loads a length index for a FASTA/FASTQ file (gzipped or not). The index
+holds each record's name, sequence length and byte offset (in the uncompressed file), in file order.
+
+The index is saved in a binary sidecar file next to the sequence file (with a .lenidx extension).
+The sidecar stores the sequence file's size and modification time, and it is rebuilt if either
+changes. If the sidecar can't be written (e.g. a read-only directory), the index is still returned.
+
+Sidecar layout (little-endian):
+  * 8-byte magic
+  * header: sequence file size, sequence file mtime (ns), record count, names length (4 x 8 bytes)
+  * names: newline-separated record names
+  * lengths: one unsigned 8-byte int per record
+  * offsets: one unsigned 8-byte int per record
+"""
+
+import array
+import os
+import struct
+import sys
+
+import seq_io
+
+
+INDEX_EXTENSION = '.lenidx'
+INDEX_MAGIC = b'LENIDX\x00\x01'
+INDEX_HEADER = struct.Struct('<QqQQ')
+
+
+def get_index_filename(filename):
+    return filename + INDEX_EXTENSION
+
+
+def load_index(filename, write_index=True):
+    """
+    Returns (names, lengths, offsets) for the records in the file. The sidecar index is used if it
+    is up to date, otherwise the sequence file is parsed (and the sidecar written).
+    """
+    if not os.path.isfile(filename):
+        sys.exit('Error: could not find ' + filename)
+    stamp = get_file_stamp(filename)
+    index_filename = get_index_filename(filename)
+    index = read_index_file(index_filename, stamp)
+    if index is not None:
+        return index
+    index = build_index(filename)
+    if write_index:
+        write_index_file(index_filename, stamp, index)
+    return index
+
+
+def get_file_stamp(filename):
+    file_stat = os.stat(filename)
+    return file_stat.st_size, file_stat.st_mtime_ns
+
+
+def read_index_file(index_filename, stamp):
+    """
+    Returns the index stored in the sidecar file, or None if the sidecar is missing, stale or
+    unreadable.
+    """
+    try:
+        with open(index_filename, 'rb') as index_file:
+            if index_file.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                return None
+            header = index_file.read(INDEX_HEADER.size)
+            if len(header) != INDEX_HEADER.size:
+                return None
+            size, mtime, count, names_size = INDEX_HEADER.unpack(header)
+            if (size, mtime) != stamp:
+                return None
+            names_blob = index_file.read(names_size)
+            lengths, offsets = array.array('Q'), array.array('Q')
+            lengths.fromfile(index_file, count)
+            offsets.fromfile(index_file, count)
+    except (OSError, EOFError):
+        return None
+    if sys.byteorder == 'big':
+        lengths.byteswap()
+        offsets.byteswap()
+    names = names_blob.decode().split('\n') if count > 0 else []
+    if len(names) != count:
+        return None
+    return names, lengths, offsets
+
+
+def write_index_file(index_filename, stamp, index):
+    names, lengths, offsets = index
+    names_blob = '\n'.join(names).encode()
+    if sys.byteorder == 'big':
+        lengths, offsets = array.array('Q', lengths), array.array('Q', offsets)
+        lengths.byteswap()
+        offsets.byteswap()
+    temp_filename = index_filename + '.temp'
+    try:
+        with open(temp_filename, 'wb') as index_file:
+            index_file.write(INDEX_MAGIC)
+            index_file.write(INDEX_HEADER.pack(stamp[0], stamp[1], len(names), len(names_blob)))
+            index_file.write(names_blob)
+            lengths.tofile(index_file)
+            offsets.tofile(index_file)
+        os.replace(temp_filename, index_filename)
+    except OSError as e:
+        print('\nWarning: could not write {} ({})'.format(index_filename, e.strerror),
+              file=sys.stderr)
+
+
+def build_index(filename):
+    names, lengths, offsets = [], array.array('Q'), array.array('Q')
+    _, records = seq_io.iterate_records(filename)
+    for record in records:
+        names.append(seq_io.get_name(record[1]))
+        lengths.append(len(record[2]))
+        offsets.append(record[0])
+    return names, lengths, offsets
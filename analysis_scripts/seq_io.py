@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""
+Copyright 2019 Ryan Wick (rrwick@gmail.com)
+https://github.com/rrwick/Basecalling-comparison
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. This program is distributed in the hope that it
+will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details. You should
+have received a copy of the GNU General Public License along with this program. If not, see
+<http://www.gnu.org/licenses/>.
+
+This module has the FASTA/FASTQ parsing shared by the analysis scripts.
+
+Files are read in large binary chunks (decompressed with zlib for gzipped files) and record
+boundaries are found with bytes.find, so there is no per-line decoding, stripping or splitting.
+Records are yielded as memoryview slices of the chunk buffer: use bytes() on the parts you want to
+keep, as the views are only cheap while the buffer is alive. Sequences are never decoded here.
+
+Both parsers yield the record's byte offset in the (uncompressed) file along with its parts:
+  * iterate_fastq: (offset, header, sequence, qualities)
+  * iterate_fasta: (offset, header, sequence)
+Headers exclude the leading '@' or '>'. Blank lines between records are skipped, so FASTQ files
+with an extra empty line after each record work too.
+
+Gzipped input is decompressed in a background thread (zlib releases the GIL while inflating), so
+decompression overlaps with parsing. For output, BgzfWriter writes block-gzipped (BGZF) data with
+blocks compressed in a thread pool. BGZF is valid multi-member gzip, so the files can be read by
+gzip/zcat as well as by htslib-based tools (samtools, nanopolish).
+"""
+
+import collections
+import concurrent.futures
+import gzip
+import os
+import queue
+import struct
+import sys
+import threading
+import zlib
+
+
+CHUNK_SIZE = 1 << 16
+GZIP_WBITS = zlib.MAX_WBITS | 16
+WHITESPACE = b' \t\r\n\x0b\x0c'
+BACKGROUND_QUEUE_SIZE = 16
+
+BGZF_BLOCK_SIZE = 0xff00  # uncompressed bytes per block, as used by htslib
+BGZF_HEADER = struct.Struct('<BBBBIBBHBBHH')
+BGZF_FOOTER = struct.Struct('<II')
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def get_compression_type(filename):
+    """
+    Attempts to guess the compression (if any) on a file using the first few bytes.
+    http://stackoverflow.com/questions/13044562
+    """
+    magic_dict = {'gz': (b'\x1f', b'\x8b', b'\x08'),
+                  'bz2': (b'\x42', b'\x5a', b'\x68'),
+                  'zip': (b'\x50', b'\x4b', b'\x03', b'\x04')}
+    max_len = max(len(x) for x in magic_dict)
+
+    unknown_file = open(filename, 'rb')
+    file_start = unknown_file.read(max_len)
+    unknown_file.close()
+    compression_type = 'plain'
+    for filetype, magic_bytes in magic_dict.items():
+        if file_start.startswith(magic_bytes):
+            compression_type = filetype
+    if compression_type == 'bz2':
+        sys.exit('Error: cannot use bzip2 format - use gzip instead')
+    if compression_type == 'zip':
+        sys.exit('Error: cannot use zip format - use gzip instead')
+    return compression_type
+
+
+def get_sequence_file_type(filename):
+    if not os.path.isfile(filename):
+        sys.exit('Error: could not find ' + filename)
+    if get_compression_type(filename) == 'gz':
+        open_func = gzip.open
+    else:  # plain text
+        open_func = open
+    with open_func(filename, 'rb') as seq_file:
+        first_char = seq_file.read(1)
+    if first_char == b'>':
+        return 'FASTA'
+    elif first_char == b'@':
+        return 'FASTQ'
+    else:
+        raise ValueError('File is neither FASTA or FASTQ')
+
+
+def iterate_records(filename):
+    """
+    Returns the file type ('FASTA' or 'FASTQ') and an iterator over the file's records.
+    """
+    file_type = get_sequence_file_type(filename)
+    chunks = iterate_chunks(filename)
+    if file_type == 'FASTA':
+        return file_type, iterate_fasta(chunks)
+    else:  # FASTQ
+        return file_type, iterate_fastq(chunks)
+
+
+def iterate_chunks(filename):
+    """
+    Yields the (uncompressed) contents of the file in large chunks.
+    """
+    if get_compression_type(filename) == 'gz':
+        yield from iterate_gzip_chunks(filename)
+    else:  # plain text
+        with open(filename, 'rb') as plain_file:
+            while True:
+                chunk = plain_file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+
+def iterate_gzip_chunks(filename):
+    return iterate_in_background(decompress_gzip_chunks(filename))
+
+
+def decompress_gzip_chunks(filename):
+    """
+    Decompresses a gzip file one chunk at a time. Files with multiple gzip members (e.g. BGZF or
+    concatenated gzip files) are handled by starting a new decompressor after each member.
+    """
+    with open(filename, 'rb') as gzip_file:
+        decompressor = zlib.decompressobj(GZIP_WBITS)
+        in_member = False
+        while True:
+            data = gzip_file.read(CHUNK_SIZE)
+            if not data:
+                break
+            while data:
+                in_member = True
+                chunk = decompressor.decompress(data)
+                if chunk:
+                    yield chunk
+                if decompressor.eof:
+                    data = decompressor.unused_data.lstrip(b'\x00')  # ignore trailing padding
+                    decompressor = zlib.decompressobj(GZIP_WBITS)
+                    in_member = False
+                else:
+                    data = b''
+        if in_member:
+            raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+
+
+def iterate_in_background(items):
+    """
+    Runs an iterator in a separate thread, handing its items over through a bounded queue. Any
+    exception raised by the iterator is re-raised in the consuming thread.
+    """
+    item_queue = queue.Queue(maxsize=BACKGROUND_QUEUE_SIZE)
+    finished = object()
+    stopping = threading.Event()
+
+    def put(item):
+        while not stopping.is_set():
+            try:
+                item_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put(item):
+                    return
+            put(finished)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = item_queue.get()
+            if item is finished:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopping.set()
+        thread.join()
+
+
+class BgzfWriter(object):
+    """
+    A file-like writer for BGZF (block gzip) output. Each block is compressed independently, so
+    with more than one thread the blocks are compressed in parallel and then written in order.
+    """
+    def __init__(self, out_file, threads=1, level=6):
+        self.out_file = out_file
+        self.threads = threads
+        self.level = level
+        self.buffer = bytearray()
+        self.pending_blocks = collections.deque()
+        if threads > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        else:
+            self.executor = None
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) < BGZF_BLOCK_SIZE:
+            return
+        full_size = len(self.buffer) - (len(self.buffer) % BGZF_BLOCK_SIZE)
+        for start in range(0, full_size, BGZF_BLOCK_SIZE):
+            self.add_block(bytes(self.buffer[start:start + BGZF_BLOCK_SIZE]))
+        del self.buffer[:full_size]
+
+    def add_block(self, data):
+        if self.executor is None:
+            self.out_file.write(compress_bgzf_block(data, self.level))
+            return
+        self.pending_blocks.append(self.executor.submit(compress_bgzf_block, data, self.level))
+        while len(self.pending_blocks) > self.threads * 4:
+            self.out_file.write(self.pending_blocks.popleft().result())
+
+    def close(self):
+        if self.buffer:
+            self.add_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending_blocks:
+            self.out_file.write(self.pending_blocks.popleft().result())
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.out_file.write(BGZF_EOF)
+        self.out_file.flush()
+
+    def abort(self):
+        """
+        Stops writing without the EOF marker, so the incomplete output doesn't look like a whole
+        BGZF file to other tools.
+        """
+        for block in self.pending_blocks:
+            block.cancel()
+        self.pending_blocks.clear()
+        self.buffer = bytearray()
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.out_file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def compress_bgzf_block(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    compressed = compressor.compress(data) + compressor.flush()
+    block_size = BGZF_HEADER.size + len(compressed) + BGZF_FOOTER.size
+    header = BGZF_HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, block_size - 1)
+    footer = BGZF_FOOTER.pack(zlib.crc32(data) & 0xffffffff, len(data))
+    return header + compressed + footer
+
+
+def iterate_fastq(chunks):
+    chunks = iter(chunks)
+    buffer, view = b'', memoryview(b'')
+    buffer_offset, pos = 0, 0
+    at_end = False
+    while True:
+        # Skip any blank lines before the record.
+        while pos < len(buffer) and buffer[pos] in (10, 13):
+            pos += 1
+
+        header_end = buffer.find(b'\n', pos)
+        seq_end = -1 if header_end == -1 else buffer.find(b'\n', header_end + 1)
+        plus_end = -1 if seq_end == -1 else buffer.find(b'\n', seq_end + 1)
+        qual_end = -1 if plus_end == -1 else buffer.find(b'\n', plus_end + 1)
+
+        if qual_end == -1:
+            if not at_end:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    at_end = True
+                else:
+                    buffer_offset += pos
+                    buffer = buffer[pos:] + chunk
+                    view = memoryview(buffer)
+                    pos = 0
+                continue
+            if pos >= len(buffer):
+                break
+            if plus_end == -1:
+                raise IndexError('truncated FASTQ record')
+            qual_end = len(buffer)  # last record has no trailing newline
+
+        # The sequence line is assumed to end the same way as the header line (CRLF or LF).
+        cr = 1 if buffer[header_end - 1] == 13 else 0
+        qual_stop = qual_end - 1 if buffer[qual_end - 1] == 13 else qual_end
+        yield (buffer_offset + pos, view[pos + 1:header_end - cr],
+               view[header_end + 1:seq_end - cr], view[plus_end + 1:qual_stop])
+        pos = qual_end + 1
+
+
+def iterate_fasta(chunks):
+    chunks = iter(chunks)
+    buffer, view = b'', memoryview(b'')
+    buffer_offset, pos, search_pos = 0, 0, 0
+    at_end = False
+    while True:
+        # Skip any blank lines before the record.
+        while pos < len(buffer) and buffer[pos] in (10, 13):
+            pos += 1
+        search_pos = max(search_pos, pos)
+
+        next_record = buffer.find(b'\n>', search_pos)
+        if next_record == -1:
+            if not at_end:
+                # Long sequences span many chunks, so chunks are gathered until one could hold the
+                # next header and then joined once, instead of growing the buffer chunk by chunk.
+                pending = [buffer[pos:]]
+                while True:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        at_end = True
+                        break
+                    pending.append(chunk)
+                    if b'>' in chunk:
+                        break
+                buffer_offset += pos
+                search_pos = max(len(pending[0]) - 1, 0)
+                buffer = b''.join(pending)
+                view = memoryview(buffer)
+                pos = 0
+                continue
+            if pos >= len(buffer):
+                break
+            record_end = len(buffer)
+        else:
+            record_end = next_record + 1
+
+        header_end = buffer.find(b'\n', pos, record_end)
+        if header_end == -1:
+            header_end = record_end
+        header = view[pos + 1:strip_cr(buffer, pos + 1, header_end)]
+
+        # Single-line sequences can be returned as a view, but multi-line sequences need joining.
+        seq_start = min(header_end + 1, record_end)
+        seq_end = record_end
+        if seq_end > seq_start and buffer[seq_end - 1] == 10:
+            seq_end -= 1
+        seq_end = strip_cr(buffer, seq_start, seq_end)
+        if buffer.find(b'\n', seq_start, seq_end) == -1:
+            sequence = view[seq_start:seq_end]
+        else:
+            sequence = buffer[seq_start:seq_end].translate(None, WHITESPACE)
+
+        yield buffer_offset + pos, header, sequence
+        pos, search_pos = record_end, record_end
+
+
+def strip_cr(buffer, start, end):
+    """
+    Returns the line end position, moved back by one if the line ends in a carriage return.
+    """
+    if end > start and buffer[end - 1] == 13:
+        return end - 1
+    return end
+
+
+def get_name(header):
+    """
+    Returns the record name (the header up to the first whitespace) as a string.
+    """
+    return bytes(header).split(None, 1)[0].decode()
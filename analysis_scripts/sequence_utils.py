@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Copyright 2019 Ryan Wick (rrwick@gmail.com)
+https://github.com/rrwick/Basecalling-comparison
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. This program is distributed in the hope that it
+will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details. You should
+have received a copy of the GNU General Public License along with this program. If not, see
+<http://www.gnu.org/licenses/>.
+
+This module has sequence functions shared by the scripts.
+
+Reverse complementing is done with str.translate/bytes.translate, so it runs in C instead of
+looking up each base in Python. IUPAC codes are complemented (keeping their case), and any
+character not in REV_COMP_DICT becomes 'N'.
+"""
+
+
+REV_COMP_DICT = {'A': 'T', 'T': 'A', 'G': 'C', 'C': 'G',
+                 'a': 't', 't': 'a', 'g': 'c', 'c': 'g',
+                 'R': 'Y', 'Y': 'R', 'S': 'S', 'W': 'W',
+                 'K': 'M', 'M': 'K', 'B': 'V', 'V': 'B',
+                 'D': 'H', 'H': 'D', 'N': 'N',
+                 'r': 'y', 'y': 'r', 's': 's', 'w': 'w',
+                 'k': 'm', 'm': 'k', 'b': 'v', 'v': 'b',
+                 'd': 'h', 'h': 'd', 'n': 'n',
+                 '.': '.', '-': '-', '?': '?'}
+
+
+class ComplementTable(dict):
+    """
+    A str.translate table which maps any character it doesn't have to 'N'.
+    """
+    def __missing__(self, key):
+        return 'N'
+
+
+COMPLEMENT_TABLE = ComplementTable({ord(base): complement
+                                    for base, complement in REV_COMP_DICT.items()})
+COMPLEMENT_BYTES = bytes(ord(REV_COMP_DICT.get(chr(i), 'N')) for i in range(256))
+
+
+def reverse_complement(seq):
+    """
+    Returns the reverse complement of a str, bytes or bytearray sequence (as the same type).
+    """
+    if isinstance(seq, str):
+        return seq.translate(COMPLEMENT_TABLE)[::-1]
+    return seq.translate(COMPLEMENT_BYTES)[::-1]
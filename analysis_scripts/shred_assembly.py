@@ -20,74 +20,86 @@ import random
 import sys
 import uuid
 
+import reference_store
+
+
+# Qualities are drawn uniformly from 'A' to 'K' (11 values). Random bytes at or above the largest
+# multiple of 11 are discarded so the remaining bytes map evenly onto the qualities.
+QUAL_MIN, QUAL_MAX = 65, 75
+QUAL_COUNT = QUAL_MAX - QUAL_MIN + 1
+QUAL_LIMIT = 256 - (256 % QUAL_COUNT)
+QUAL_TABLE = bytes(QUAL_MIN + (i % QUAL_COUNT) if i < QUAL_LIMIT else 0 for i in range(256))
+QUAL_REJECT = bytes(range(QUAL_LIMIT, 256))
+QUAL_BATCH_SIZE = 1 << 20  # quality characters generated at once
+
 
 def main():
-    assembly = load_fasta(sys.argv[1])
-    random.seed(int(sys.argv[2]))
-    read_length = int(sys.argv[3])
+    assembly = reference_store.load_reference_store(sys.argv[1], cache=False)
+    write_shreds(assembly, int(sys.argv[2]), int(sys.argv[3]), sys.stdout.buffer)
+
+
+def write_shreds(assembly, seed, read_length, out):
+    """
+    Writes the shredded reads (FASTQ) of a one-contig reference store to a binary file.
+    """
+    rng = random.Random(seed)
     assert len(assembly) == 1
-    assembly_seq = assembly[0][1]
-    assert len(assembly_seq) > 1000000
+    contig = assembly.get_circular_sequence(assembly.names[0])
+    contig_rev = contig.reverse_complemented()
+    contig_length = len(contig)
+    assert contig_length > 1000000
 
     # Add a bit of overlap so reads can span the junction.
-    assembly_seq = assembly_seq + assembly_seq[:read_length]
-
-    read_start = 0
-    read_end = read_length
-    while read_end <= len(assembly_seq):
-        read_seq = assembly_seq[read_start:read_end]
-        if random.random() < 0.5:
-            read_seq = reverse_complement(read_seq)
-        read_qual = ''.join([chr(random.randint(65, 75)) for _ in range(read_length)])
-        print('@' + str(uuid.uuid4()))
-        print(read_seq)
-        print('+')
-        print(read_qual)
-        read_start += read_length // 3
-        read_end += read_length // 3
-
-
-def load_fasta(fasta_filename):
-    fasta_seqs = []
-    with open(fasta_filename, 'rt') as fasta_file:
-        name = ''
-        sequence = []
-        for line in fasta_file:
-            line = line.strip()
-            if not line:
-                continue
-            if line[0] == '>':  # Header line = start of new contig
-                if name:
-                    fasta_seqs.append((name.split()[0], ''.join(sequence), name))
-                    sequence = []
-                name = line[1:]
-            else:
-                sequence.append(line)
-        if name:
-            fasta_seqs.append((name.split()[0], ''.join(sequence), name))
-    return fasta_seqs
-
-
-REV_COMP_DICT = {'A': 'T', 'T': 'A', 'G': 'C', 'C': 'G',
-                 'a': 't', 't': 'a', 'g': 'c', 'c': 'g',
-                 'R': 'Y', 'Y': 'R', 'S': 'S', 'W': 'W',
-                 'K': 'M', 'M': 'K', 'B': 'V', 'V': 'B',
-                 'D': 'H', 'H': 'D', 'N': 'N',
-                 'r': 'y', 'y': 'r', 's': 's', 'w': 'w',
-                 'k': 'm', 'm': 'k', 'b': 'v', 'v': 'b',
-                 'd': 'h', 'h': 'd', 'n': 'n',
-                 '.': '.', '-': '-', '?': '?'}
-
-
-def complement_base(base):
-    try:
-        return REV_COMP_DICT[base]
-    except KeyError:
-        return 'N'
-
-
-def reverse_complement(seq):
-    return ''.join([complement_base(x) for x in seq][::-1])
+    step = read_length // 3
+    read_count = contig_length // step + 1
+
+    # All random values come from the seeded generator, so the output (including the read names)
+    # only depends on the seed. Qualities are made in batches of reads to limit memory use.
+    strands = get_random_bits(rng, read_count)
+    names = [str(uuid.UUID(int=rng.getrandbits(128), version=4)) for _ in range(read_count)]
+    batch_reads = max(1, QUAL_BATCH_SIZE // max(read_length, 1))
+
+    # Each read is written straight from the contig view, wrapping around the end of the contig for
+    # the reads which span the junction. A reverse-strand read from start to end is the reverse
+    # complement view's slice from (length - end) to (length - start).
+    for i in range(read_count):
+        if i % batch_reads == 0:
+            quals = get_quality_bytes(rng, min(batch_reads, read_count - i) * read_length)
+        j = i % batch_reads
+        read_start, read_end = i * step, i * step + read_length
+        out.write(b'@' + names[i].encode() + b'\n')
+        if strands[i]:
+            contig_rev.write(out, contig_length - read_end, contig_length - read_start)
+        else:
+            contig.write(out, read_start, read_end)
+        out.write(b'\n+\n')
+        out.write(quals[j * read_length:(j + 1) * read_length])
+        out.write(b'\n')
+    out.flush()
+
+
+def get_random_bits(rng, count):
+    """
+    Returns a list of count random booleans.
+    """
+    bits = rng.getrandbits(count) if count > 0 else 0
+    return [bool((bits >> i) & 1) for i in range(count)]
+
+
+def get_quality_bytes(rng, count):
+    """
+    Returns count random quality characters (as bytes), uniformly distributed from QUAL_MIN to
+    QUAL_MAX.
+    """
+    quals, quals_length = [], 0
+    while quals_length < count:
+        # Request a little extra to cover the rejected bytes (about 2% of them).
+        request = (count - quals_length) * 33 // 32 + 64
+        raw = rng.getrandbits(request * 8).to_bytes(request, 'little')
+        chunk = raw.translate(QUAL_TABLE, QUAL_REJECT)
+        quals.append(chunk)
+        quals_length += len(chunk)
+    return b''.join(quals)[:count]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Copyright 2019 Ryan Wick (rrwick@gmail.com)
+https://github.com/rrwick/Basecalling-comparison
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. This program is distributed in the hope that it
+will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details. You should
+have received a copy of the GNU General Public License along with this program. If not, see
+<http://www.gnu.org/licenses/>.
+
+This module has the fast5 reading and writing shared by the Sloika prep scripts.
+
+Two fast5 layouts are supported:
+  * single-read: one read per file, with the signal at Raw/Reads/Read_*/Signal and the channel and
+    tracking info in UniqueGlobalKey
+  * multi-read: any number of reads per file, each in its own read_<id> group with the signal at
+    read_<id>/Raw/Signal and its own channel_id, context_tags and tracking_id groups
+
+Reads can be written to multi-read files from either layout, so passing reads can be gathered into
+batch files instead of one file per read.
+
+Signals are found by looking directly at the places the layouts keep them, so files with many
+other objects (basecall groups, event tables, etc.) don't have to be walked. Only files in neither
+layout are searched in full for their /Signal dataset.
+"""
+
+import collections
+import h5py
+import os
+
+
+MULTI_READ_PREFIX = 'read_'
+MULTI_READ_VERSION = '2.0'
+SINGLE_READ_GLOBAL_GROUPS = ['channel_id', 'context_tags', 'tracking_id']
+SINGLE_READ_READS_LOCATION = 'Raw/Reads'
+
+SINGLE_READ_LAYOUT = 'single-read'
+MULTI_READ_LAYOUT = 'multi-read'
+OTHER_LAYOUT = 'other'
+
+# The layout last seen in each directory (see get_layout).
+directory_layouts = {}
+
+
+# A read in a fast5 file:
+#   read_id: the read's ID
+#   group: the read's group in a multi-read file ('' for a single-read file)
+#   raw_location: the group holding the read's signal (and its attributes, e.g. duration)
+#   signal_location: the signal dataset
+Fast5Read = collections.namedtuple('Fast5Read',
+                                   ['read_id', 'group', 'raw_location', 'signal_location'])
+
+
+def is_multi_read(hdf5_file):
+    return get_layout(hdf5_file) == MULTI_READ_LAYOUT
+
+
+def get_layout(hdf5_file):
+    """
+    Returns the file's layout. The layout found for each directory is remembered and checked first
+    for later files in that directory, so they usually don't need the full discovery. A file in
+    neither known layout can't be confirmed that way, so it is never used as the remembered layout.
+    """
+    directory = os.path.dirname(os.path.abspath(hdf5_file.filename))
+    layout = directory_layouts.get(directory)
+    if layout is not None and has_layout(hdf5_file, layout):
+        return layout
+    for layout in (SINGLE_READ_LAYOUT, MULTI_READ_LAYOUT):
+        if has_layout(hdf5_file, layout):
+            directory_layouts[directory] = layout
+            return layout
+    return OTHER_LAYOUT
+
+
+def has_layout(hdf5_file, layout):
+    if layout == SINGLE_READ_LAYOUT:
+        return get_single_read_signal_location(hdf5_file) is not None
+    else:  # MULTI_READ_LAYOUT
+        return any(name.startswith(MULTI_READ_PREFIX) for name in hdf5_file)
+
+
+def get_reads(hdf5_file):
+    """
+    Returns a Fast5Read for each read in the file, in file order.
+    """
+    layout = get_layout(hdf5_file)
+    if layout == MULTI_READ_LAYOUT:
+        reads = []
+        for name in hdf5_file:
+            if not name.startswith(MULTI_READ_PREFIX):
+                continue
+            raw_location = name + '/Raw'
+            read_id = get_read_id(hdf5_file[raw_location], name[len(MULTI_READ_PREFIX):])
+            reads.append(Fast5Read(read_id, name, raw_location, raw_location + '/Signal'))
+        return reads
+    if layout == SINGLE_READ_LAYOUT:
+        signal_location = get_single_read_signal_location(hdf5_file)
+    else:
+        signal_location = get_signal_location(hdf5_file)
+    raw_location = signal_location.replace('/Signal', '')
+    default_read_id = os.path.splitext(os.path.basename(hdf5_file.filename))[0]
+    read_id = get_read_id(hdf5_file[raw_location], default_read_id)
+    return [Fast5Read(read_id, '', raw_location, signal_location)]
+
+
+def get_single_read_signal_location(hdf5_file):
+    """
+    Returns the signal's location in a standard single-read file (Raw/Reads/Read_*/Signal), or
+    None if the file isn't laid out that way. Only the groups on that path are looked at.
+    """
+    reads_group = hdf5_file.get(SINGLE_READ_READS_LOCATION)
+    if not isinstance(reads_group, h5py.Group) or len(reads_group) != 1:
+        return None
+    signal_location = '{}/{}/Signal'.format(SINGLE_READ_READS_LOCATION, next(iter(reads_group)))
+    if not isinstance(hdf5_file.get(signal_location), h5py.Dataset):
+        return None
+    return signal_location
+
+
+def get_read_id(raw_group, default_read_id):
+    read_id = raw_group.attrs.get('read_id', default_read_id)
+    if isinstance(read_id, bytes):
+        read_id = read_id.decode()
+    return str(read_id)
+
+
+def get_signal_location(hdf5_file):
+    """
+    Finds the signal by looking at every object in the file, for files not in a known layout.
+    """
+    names = []
+    hdf5_file.visit(names.append)
+    signal_locations = sorted([x for x in names if x.endswith('/Signal')])
+    assert len(signal_locations) == 1
+    return signal_locations[0]
+
+
+def copy_hdf5_group(group, new_group, skip_location=None):
+    """
+    Copies the attributes and contents of an HDF5 group, except for the object at skip_location
+    (the groups on the path to it are still made).
+    """
+    copy_hdf5_attributes(group, new_group)
+    for name in group:
+        location = (group.name.rstrip('/') + '/' + name).lstrip('/')
+        if location == skip_location:
+            continue
+        if skip_location is not None and skip_location.startswith(location + '/'):
+            copy_hdf5_group(group[name], new_group.create_group(name), skip_location)
+        else:
+            group.copy(name, new_group)
+
+
+def copy_hdf5_attributes(source, destination):
+    for name in source.attrs:
+        destination.attrs.create(name, source.attrs[name], dtype=source.attrs.get_id(name).dtype)
+
+
+def write_signal(raw_group, signal, compression_level):
+    """
+    Writes a (new) signal into a read's raw group and updates the read's duration to match.
+    """
+    raw_group.create_dataset('Signal', compression='gzip', compression_opts=compression_level,
+                             data=signal)
+    raw_group.attrs['duration'] = len(signal)
+
+
+def create_multi_read_file(filename):
+    new_hdf5_file = h5py.File(filename, 'w-')
+    new_hdf5_file.attrs['file_version'] = MULTI_READ_VERSION
+    return new_hdf5_file
+
+
+def copy_read(hdf5_file, read, new_hdf5_file, signal=None, compression_level=9):
+    """
+    Copies a read (from either layout) into a multi-read file. If a signal is given, it replaces
+    the read's original signal.
+    """
+    read_group = new_hdf5_file.create_group(MULTI_READ_PREFIX + read.read_id)
+    skip_location = None if signal is None else read.signal_location
+    if read.group:
+        copy_hdf5_group(hdf5_file[read.group], read_group, skip_location)
+    else:
+        for name in SINGLE_READ_GLOBAL_GROUPS:
+            if 'UniqueGlobalKey/' + name in hdf5_file:
+                hdf5_file.copy('UniqueGlobalKey/' + name, read_group)
+        if 'Analyses' in hdf5_file:
+            hdf5_file.copy('Analyses', read_group)
+        raw_group = read_group.create_group('Raw')
+        copy_hdf5_attributes(hdf5_file[read.raw_location], raw_group)
+        if signal is None:
+            hdf5_file.copy(read.signal_location, raw_group, 'Signal')
+    if signal is not None:
+        write_signal(read_group['Raw'], signal, compression_level)
+
+
+def get_batches(items, batch_size):
+    """
+    Splits a list into batches of batch_size items (the last batch may be smaller).
+    """
+    return [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+
+
+def get_batch_filename(out_dir, batch_num):
+    return '{}/batch_{:05d}.fast5'.format(out_dir, batch_num)
@@ -13,15 +13,46 @@ have received a copy of the GNU General Public License along with this program.
 
 This script filters fast5 reads based on their alignment to reference contigs.
 The reads which pass filtering should be suitable for Sloika training.
+
+The pass/fail checks can be spread over multiple processes (--threads), and passing fast5 files are
+copied in a thread pool (--copy_threads) while the per-read references are written. With
+--copy_mode hardlink or reflink, files are linked instead of copied where the filesystem allows it.
+Reads are handled in sorted filename order, so the reference FASTA is the same for every run, and a
+summary of the pass/fail counts is printed at the end.
+
+Multi-read fast5s work too (see fast5_utils.py), with read IDs for each file coming from the
+sequencing summary. By default, each fast5 file with passing reads gives one output file of the
+same name: a copy if all of its reads passed, otherwise a multi-read file with just the passing
+reads. With --batch_size, passing reads are instead gathered into multi-read files
+(batch_00000.fast5, etc.) of that many reads. References are named after the fast5 file for reads
+in single-read files (copied as they are) and with the read ID otherwise.
+
+The reference contigs are loaded with reference_store.py and reverse complemented with
+sequence_utils.py, both from analysis_scripts, which must be importable (per-isolate_commands.sh
+puts it on PYTHONPATH).
 """
 
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import functools
 import glob
+import h5py
+import multiprocessing
 import os
 import re
 import shutil
 import sys
 
+import fast5_utils
+import reference_store
+import sequence_utils
+
+
+READS_PER_CHUNK = 100
+FICLONE = 0x40049409  # Linux ioctl for making a reflink (copy-on-write clone) of a file
+
 
 def get_arguments():
     parser = argparse.ArgumentParser(description='Trim fast5 files at the signal level')
@@ -35,6 +66,17 @@ def get_arguments():
                              'fraction of indels')
     parser.add_argument('--window_size', type=int, required=False, default=25,
                         help='Window size for CIGAR indel check')
+    parser.add_argument('--threads', type=int, required=False, default=1,
+                        help='Number of processes to use for the read checks')
+    parser.add_argument('--copy_threads', type=int, required=False, default=8,
+                        help='Number of threads to use for copying passing fast5 files')
+    parser.add_argument('--copy_mode', type=str, required=False, default='copy',
+                        choices=['copy', 'hardlink', 'reflink'],
+                        help='How to put passing fast5 files in the output directory (hardlink '
+                             'and reflink fall back to copying when they are not possible)')
+    parser.add_argument('--batch_size', type=int, required=False, default=0,
+                        help='Write passing reads to multi-read fast5 files of this many reads '
+                             '(default: one output file for each input file with passing reads)')
 
     parser.add_argument('in_fast5_dir', type=str,
                         help='Directory containing trimmed fast5 files')
@@ -56,77 +98,242 @@ def get_arguments():
 
 def main():
     args = get_arguments()
-    filename_to_read_id = read_seq_summary(args.seq_summary)
+    filename_to_read_ids = read_seq_summary(args.seq_summary)
     read_id_to_alignment_info = read_paf(args.paf_alignment)
     make_output_dir(args.out_fast5_dir)
-    references = load_fasta(args.reference)
-
-    with open(args.out_ref, 'w') as out_ref:
-        for fast5_file in glob.iglob(args.in_fast5_dir + '/**/*.fast5', recursive=True):
-            print()
-            print(fast5_file)
-            filename = fast5_file.rpartition('/')[2]
-            read_id = filename_to_read_id[filename]
-            print('    ID: {}'.format(read_id))
-
-            try:
-                read_length, read_start, read_end, cigar, _, strand, contig_name, contig_start, contig_end = read_id_to_alignment_info[read_id]
-            except KeyError:
-                print('    FAIL due to no alignment')
-                continue
-
-            print('    Length: {:,} bp'.format(read_length))
-            if read_length < args.min_basecalled_length:
-                print('    FAIL due to short length')
-                continue
-
-            unaligned_bases = read_start + (read_length - read_end)
-            print('    Unaligned: {:,} bp'.format(unaligned_bases))
-            if unaligned_bases > args.max_unaligned_bases:
-                print('    FAIL due to too much unaligned')
-                continue
-
-            expanded_cigar = get_expanded_cigar(cigar)
-            worst_window_indel_fraction = 0.0
-            for i in range(len(expanded_cigar) - args.window_size):
-                cigar_window = expanded_cigar[i:i+args.window_size]
-                window_indel_fraction = (cigar_window.count('I') + cigar_window.count('D')) / args.window_size
-                worst_window_indel_fraction = max(worst_window_indel_fraction, window_indel_fraction)
-            print('    Worst window indels: {:.4f}'.format(worst_window_indel_fraction))
-            if worst_window_indel_fraction > args.max_window_indels:
-                print('    FAIL due to bad window indels')
-                continue
-
-            print('    PASS')
-            new_file = '{}/{}'.format(args.out_fast5_dir, filename)
-            print('    making a copy here: {}'.format(new_file))
-            if os.path.exists(new_file):
-                print()
-                sys.exit('Error: {} already exists'.format(new_file))
-            shutil.copyfile(fast5_file, new_file)
-
-            print('    getting reference sequence from {} ({}-{}, {} strand)'.format(contig_name, contig_start, contig_end, strand))
-            ref_header = '>' + os.path.basename(os.path.splitext(fast5_file)[0])
-            ref_seq = references[contig_name][contig_start:contig_end]
-            if strand == '-':
-                ref_seq = reverse_complement(ref_seq)
-
-            out_ref.write(ref_header)
-            out_ref.write('\n')
-            out_ref.write(ref_seq)
-            out_ref.write('\n')
+    references = reference_store.load_reference_store(args.reference, cache=False)
+
+    fast5_files = sorted(glob.glob(args.in_fast5_dir + '/**/*.fast5', recursive=True))
+    reads = get_reads(fast5_files, filename_to_read_ids)
+    alignments = [read_id_to_alignment_info.get(read_id) for _, read_id in reads]
+    check_fail = functools.partial(get_fail_reason,
+                                   min_basecalled_length=args.min_basecalled_length,
+                                   max_unaligned_bases=args.max_unaligned_bases,
+                                   max_window_indels=args.max_window_indels,
+                                   window_size=args.window_size)
+    fail_counts = collections.Counter()
+    passing = []
+    for i, (read, alignment_info, fail_reason) in \
+            enumerate(iterate_fail_reasons(reads, alignments, check_fail, args.threads)):
+        if fail_reason is None:
+            passing.append((read, alignment_info))
+        else:
+            fail_counts[fail_reason] += 1
+        print_progress(i, len(reads))
+    print('', file=sys.stderr)
+
+    outputs = get_outputs(passing, filename_to_read_ids, args.out_fast5_dir, args.batch_size)
+    copy_methods = collections.Counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.copy_threads) as executor, \
+            open(args.out_ref, 'w') as out_ref:
+        copies = [executor.submit(write_output, new_file, output_reads, args.copy_mode)
+                  for new_file, output_reads in outputs]
+        for (fast5_file, read_id), alignment_info in passing:
+            ref_name = get_reference_name(fast5_file, read_id, filename_to_read_ids,
+                                          args.batch_size)
+            write_reference(ref_name, alignment_info, references, out_ref)
+        for copy in copies:
+            copy_methods[copy.result()] += 1
+
+    print_summary(len(reads), fail_counts, len(passing), copy_methods)
+
+
+def get_reads(fast5_files, filename_to_read_ids):
+    """
+    Returns (fast5 file, read ID) for each read in the fast5 files, using the sequencing summary
+    to get the read IDs (so the files don't need to be opened).
+    """
+    reads = []
+    for fast5_file in fast5_files:
+        filename = os.path.basename(fast5_file)
+        try:
+            read_ids = filename_to_read_ids[filename]
+        except KeyError:
+            sys.exit('Error: {} is not in the sequencing summary'.format(filename))
+        reads += [(fast5_file, read_id) for read_id in read_ids]
+    return reads
+
+
+def iterate_fail_reasons(reads, alignments, check_fail, threads):
+    """
+    Yields (read, alignment info, fail reason) for each read, in order. With more than one
+    thread, the checks are done in a pool of worker processes.
+    """
+    if threads <= 1:
+        fail_reasons = map(check_fail, alignments)
+        yield from zip(reads, alignments, fail_reasons)
+        return
+    pool = multiprocessing.Pool(threads)
+    try:
+        fail_reasons = pool.imap(check_fail, alignments, chunksize=READS_PER_CHUNK)
+        yield from zip(reads, alignments, fail_reasons)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def get_fail_reason(alignment_info, min_basecalled_length, max_unaligned_bases,
+                    max_window_indels, window_size):
+    """
+    Returns the reason a read fails filtering, or None if it passes.
+    """
+    if alignment_info is None:
+        return 'no alignment'
+    read_length, read_start, read_end, cigar = alignment_info[:4]
+    if read_length < min_basecalled_length:
+        return 'short length'
+    unaligned_bases = read_start + (read_length - read_end)
+    if unaligned_bases > max_unaligned_bases:
+        return 'too much unaligned'
+    if get_worst_window_indel_fraction(cigar, window_size) > max_window_indels:
+        return 'bad window indels'
+    return None
+
+
+def get_outputs(passing, filename_to_read_ids, out_fast5_dir, batch_size):
+    """
+    Returns the output files, each with the passing reads (fast5 file, read ID) which go in it.
+    Without batches, each fast5 file with any passing reads gives an output file of the same name.
+    With batches, the passing reads are gathered into multi-read files of batch_size reads.
+    """
+    passing_reads = [read for read, _ in passing]
+    if batch_size > 0:
+        return [(fast5_utils.get_batch_filename(out_fast5_dir, i), batch)
+                for i, batch in enumerate(fast5_utils.get_batches(passing_reads, batch_size))]
+    file_to_reads = collections.OrderedDict()
+    for fast5_file, read_id in passing_reads:
+        file_to_reads.setdefault(fast5_file, []).append((fast5_file, read_id))
+    outputs = [('{}/{}'.format(out_fast5_dir, os.path.basename(fast5_file)), output_reads)
+               for fast5_file, output_reads in file_to_reads.items()]
+    new_file_counts = collections.Counter(new_file for new_file, _ in outputs)
+    for new_file, _ in outputs:
+        if new_file_counts[new_file] > 1:
+            sys.exit('Error: more than one passing read would be copied to {}'.format(new_file))
+
+    # Files where every read passed are copied whole.
+    return [(new_file, output_reads[0][0] if is_whole_file(output_reads, filename_to_read_ids)
+             else output_reads) for new_file, output_reads in outputs]
+
+
+def is_whole_file(output_reads, filename_to_read_ids):
+    fast5_file = output_reads[0][0]
+    return len(output_reads) == len(filename_to_read_ids[os.path.basename(fast5_file)])
+
+
+def write_output(new_file, output_reads, copy_mode):
+    """
+    Makes one output file: either a copy of a whole fast5 file (when output_reads is a filename)
+    or a multi-read file with the given reads.
+    """
+    if isinstance(output_reads, str):
+        return copy_fast5(output_reads, new_file, copy_mode)
+    hdf5_file = None
+    try:
+        with fast5_utils.create_multi_read_file(new_file) as new_hdf5_file:
+            for fast5_file, read_id in output_reads:
+                if hdf5_file is None or hdf5_file.filename != fast5_file:
+                    if hdf5_file is not None:
+                        hdf5_file.close()
+                    hdf5_file = h5py.File(fast5_file, 'r')
+                    file_reads = {read.read_id: read for read in fast5_utils.get_reads(hdf5_file)}
+                try:
+                    read = file_reads[read_id]
+                except KeyError:
+                    raise ValueError('read {} is not in {}'.format(read_id, fast5_file))
+                fast5_utils.copy_read(hdf5_file, read, new_hdf5_file)
+    except BaseException:
+        if os.path.exists(new_file):
+            os.remove(new_file)
+        raise
+    finally:
+        if hdf5_file is not None:
+            hdf5_file.close()
+    return 'written to multi-read files'
+
+
+def copy_fast5(fast5_file, new_file, copy_mode):
+    """
+    Copies (or links) a fast5 file and returns how it was done. Hard links and reflinks only work
+    within one filesystem (and reflinks need filesystem support), so they fall back to a copy.
+    """
+    if copy_mode == 'hardlink':
+        try:
+            os.link(fast5_file, new_file)
+            return 'hard linked'
+        except OSError:
+            pass
+    elif copy_mode == 'reflink':
+        if make_reflink(fast5_file, new_file):
+            return 'reflinked'
+    shutil.copyfile(fast5_file, new_file)
+    return 'copied'
+
+
+def make_reflink(fast5_file, new_file):
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(fast5_file, 'rb') as source, open(new_file, 'wb') as destination:
+        try:
+            fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+            return True
+        except OSError:
+            return False
+
+
+def get_reference_name(fast5_file, read_id, filename_to_read_ids, batch_size):
+    """
+    References for reads in single-read fast5 files (copied as they are) are named after the file,
+    and references for reads in multi-read files are named with the read ID.
+    """
+    if batch_size == 0 and len(filename_to_read_ids[os.path.basename(fast5_file)]) == 1:
+        return os.path.basename(os.path.splitext(fast5_file)[0])
+    return read_id
+
+
+def write_reference(ref_name, alignment_info, references, out_ref):
+    strand, contig_name, contig_start, contig_end = alignment_info[5:]
+    ref_seq = references.get_sequence(contig_name, contig_start, contig_end)
+    if strand == '-':
+        ref_seq = sequence_utils.reverse_complement(ref_seq)
+
+    out_ref.write('>' + ref_name)
+    out_ref.write('\n')
+    out_ref.write(ref_seq)
+    out_ref.write('\n')
+
+
+def print_progress(done_count, total_count):
+    if (done_count + 1) % 1000 == 0 or done_count + 1 == total_count:
+        print('\r{:,} / {:,} reads checked'.format(done_count+1, total_count),
+              end='', flush=True, file=sys.stderr)
+
+
+def print_summary(read_count, fail_counts, pass_count, copy_methods):
+    print('Reads: {:,}'.format(read_count))
+    for fail_reason in ['no alignment', 'short length', 'too much unaligned', 'bad window indels']:
+        print('    FAIL due to {}: {:,}'.format(fail_reason, fail_counts[fail_reason]))
+    print('    PASS: {:,}'.format(pass_count))
+    print('Output files:')
+    for copy_method in ['copied', 'hard linked', 'reflinked', 'written to multi-read files']:
+        if copy_methods[copy_method] > 0:
+            print('    {}: {:,}'.format(copy_method, copy_methods[copy_method]))
 
 
 def read_seq_summary(seq_summary_filename):
-    filename_to_read_id = {}
+    """
+    Returns the read IDs in each fast5 file (more than one for multi-read fast5s).
+    """
+    filename_to_read_ids = collections.defaultdict(list)
     with open(seq_summary_filename, 'r') as seq_summary:
         for line in seq_summary:
             parts = line.split('\t')
             if parts[0] == 'filename':  # header line
                 continue
             filename, read_id = parts[0], parts[1]
-            filename_to_read_id[filename] = read_id
-    return filename_to_read_id
+            filename_to_read_ids[filename].append(read_id)
+    return filename_to_read_ids
 
 
 def read_paf(paf_filename):
@@ -161,15 +368,59 @@ def read_paf(paf_filename):
     return read_id_to_alignment_info
 
 
-def get_expanded_cigar(cigar):
-    expanded_cigar = []
-    cigar_parts = re.findall(r'\d+\w', cigar)
-    for cigar_part in cigar_parts:
+def get_worst_window_indel_fraction(cigar, window_size):
+    """
+    Returns the highest fraction of indels in any window of the alignment (M, I and D operations
+    only), using the windows starting at 0 to alignment length - window size - 1.
+
+    The CIGAR is never expanded. A window's indel count only stops rising when its end leaves an
+    indel run or its start enters one, so the worst window starts at one of those positions (or at
+    either end of the range) and only those windows are counted.
+    """
+    starts, ends, indels_before, alignment_length = get_indel_runs(cigar)
+    last_start = alignment_length - window_size - 1
+    if last_start < 0:
+        return 0.0
+    candidates = [0, last_start]
+    candidates += [start for start in starts if start <= last_start]
+    candidates += [end - window_size for end in ends if 0 <= end - window_size <= last_start]
+    worst_indels = 0
+    for window_start in candidates:
+        indels = get_indels_before(window_start + window_size, starts, ends, indels_before) - \
+            get_indels_before(window_start, starts, ends, indels_before)
+        worst_indels = max(worst_indels, indels)
+    return worst_indels / window_size
+
+
+def get_indel_runs(cigar):
+    """
+    Returns the start, end and number of earlier indels for each run of indels (adjacent I and D
+    operations are joined), using positions in the alignment's M, I and D operations. Also returns
+    the total length of those operations.
+    """
+    starts, ends, indels_before = [], [], []
+    pos, indels = 0, 0
+    for cigar_part in re.findall(r'\d+\w', cigar):
         num = int(cigar_part[:-1])
         letter = cigar_part[-1]
+        if letter == 'I' or letter == 'D':
+            if ends and ends[-1] == pos:
+                ends[-1] += num
+            else:
+                starts.append(pos)
+                ends.append(pos + num)
+                indels_before.append(indels)
+            indels += num
         if letter == 'M' or letter == 'I' or letter == 'D':
-            expanded_cigar.append(letter * num)
-    return ''.join(expanded_cigar)
+            pos += num
+    return starts, ends, indels_before, pos
+
+
+def get_indels_before(pos, starts, ends, indels_before):
+    i = bisect.bisect_right(starts, pos) - 1
+    if i < 0:
+        return 0
+    return indels_before[i] + min(pos, ends[i]) - starts[i]
 
 
 def make_output_dir(out_dir):
@@ -178,48 +429,5 @@ def make_output_dir(out_dir):
     os.makedirs(out_dir)
 
 
-def load_fasta(fasta_filename):
-    fasta_seqs = {}
-    with open(fasta_filename, 'rt') as fasta_file:
-        name = ''
-        sequence = []
-        for line in fasta_file:
-            line = line.strip()
-            if not line:
-                continue
-            if line[0] == '>':  # Header line = start of new contig
-                if name:
-                    fasta_seqs[name.split()[0]] = ''.join(sequence)
-                    sequence = []
-                name = line[1:]
-            else:
-                sequence.append(line)
-        if name:
-            fasta_seqs[name.split()[0]] = ''.join(sequence)
-    return fasta_seqs
-
-
-REV_COMP_DICT = {'A': 'T', 'T': 'A', 'G': 'C', 'C': 'G',
-                 'a': 't', 't': 'a', 'g': 'c', 'c': 'g',
-                 'R': 'Y', 'Y': 'R', 'S': 'S', 'W': 'W',
-                 'K': 'M', 'M': 'K', 'B': 'V', 'V': 'B',
-                 'D': 'H', 'H': 'D', 'N': 'N',
-                 'r': 'y', 'y': 'r', 's': 's', 'w': 'w',
-                 'k': 'm', 'm': 'k', 'b': 'v', 'v': 'b',
-                 'd': 'h', 'h': 'd', 'n': 'n',
-                 '.': '.', '-': '-', '?': '?'}
-
-
-def complement_base(base):
-    try:
-        return REV_COMP_DICT[base]
-    except KeyError:
-        return 'N'
-
-
-def reverse_complement(seq):
-    return ''.join([complement_base(x) for x in seq][::-1])
-
-
 if __name__ == '__main__':
     main()
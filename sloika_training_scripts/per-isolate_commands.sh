@@ -17,7 +17,8 @@
 
 
 # Edit the following paths before running, as appropriate for your environment:
-script_dir=/path/to/python_script_dir  # directory with other Python scripts (trim_signal.py, filter_reads.py and subdivide_read_dir.py)
+script_dir=/path/to/python_script_dir  # directory with other Python scripts (trim_signal.py, filter_reads.py, subdivide_read_dir.py and fast5_utils.py)
+analysis_script_dir=/path/to/analysis_scripts  # this repo's analysis_scripts directory (filter_reads.py imports reference_store.py and sequence_utils.py from here)
 r1=/path/to/reads_1.fastq.gz           # Illumina reads (pair 1)
 r2=/path/to/reads_2.fastq.gz           # Illumina reads (pair 2)
 sloika_dir=/path/to/sloika_dir         # directory of Sloika clone (https://github.com/rrwick/sloika)
@@ -27,7 +28,7 @@ sloika_dir=/path/to/sloika_dir         # directory of Sloika clone (https://gith
 skesa --fastq "$r1","$r2" --cores 16 --memory 128 > ref_contigs.fasta
 
 # Signal-level trimming of fast5s:
-python3 "$script_dir"/trim_signal.py --trim_amount 2000 --min_size 50000 01_original_fast5s 02_trimmed_fast5s
+python3 "$script_dir"/trim_signal.py --trim_amount 2000 --min_size 50000 --threads 20 01_original_fast5s 02_trimmed_fast5s
 
 # Basecalling and alignment - prep for QC:
 read_fast5_basecaller.py -f FLO-MIN106 -k SQK-LSK108 -i 02_trimmed_fast5s -t 12 -s 03_basecalling -o fastq --disable_filtering --disable_pings
@@ -36,7 +37,7 @@ minimap2 -c -x map-ont -t 20 ref_contigs.fasta temp.fastq > alignments.paf
 rm temp.fastq
 
 # Alignment-based QC and per-read references:
-python3 "$script_dir"/filter_reads.py --min_basecalled_length 5000 --max_unaligned_bases 30 --max_window_indels 0.8 --window_size 25 02_trimmed_fast5s 03_basecalling/sequencing_summary.txt ref_contigs.fasta alignments.paf 04_filtered_fast5s read_references.fasta
+PYTHONPATH="$analysis_script_dir" python3 "$script_dir"/filter_reads.py --min_basecalled_length 5000 --max_unaligned_bases 30 --max_window_indels 0.8 --window_size 25 --threads 20 02_trimmed_fast5s 03_basecalling/sequencing_summary.txt ref_contigs.fasta alignments.paf 04_filtered_fast5s read_references.fasta
 
 # Run the first round of Sloika chunky in parallel on smallish groups of reads. This means that
 # troublesome reads which hang and/or use lots of RAM only mess up their batch, not the whole
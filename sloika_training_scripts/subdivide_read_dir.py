@@ -11,40 +11,181 @@ FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more de
 have received a copy of the GNU General Public License along with this program. If not, see
 <http://www.gnu.org/licenses/>.
 
-This script moves fast5 files into subdirectories with a particular number of files per directory.
+This script moves fast5 files into subdirectories with a particular number of reads per directory.
+
+By default, each fast5 file is taken to hold one read. With --count_reads, the reads in each file
+are counted (so multi-read fast5s can be spread over directories by their number of reads).
+
+The files (in sorted order) are split between the directories before anything is moved, and a
+manifest TSV (file, directory and read count for each fast5) is written. The files are then
+renamed into their directories using a pool of threads (only files on a different filesystem are
+copied). With --symlink, the files stay where they are and are linked into the directories instead,
+and with --dry_run, only the manifest is written.
 """
 
+import argparse
+import collections
+import concurrent.futures
+import errno
 import glob
 import math
 import os
 import shutil
 import sys
 
-input_dir = sys.argv[1]
-target_reads_per_dir = int(sys.argv[2])
 
-fast5_files = glob.glob(input_dir + '/*.fast5')
-file_count = len(fast5_files)
-print('Found {} fast5 files in {}'.format(file_count, input_dir))
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Move fast5 files into subdirectories')
 
-dir_count = int(round(file_count / target_reads_per_dir))
-if dir_count == 0:
-    dir_count = 1
-files_per_dir = int(math.ceil(file_count / dir_count))
+    parser.add_argument('--count_reads', action='store_true',
+                        help='Count the reads in each fast5 file (needed for multi-read fast5s), '
+                             'instead of assuming one read per file')
+    parser.add_argument('--manifest', type=str, required=False, default=None,
+                        help='Manifest TSV of each file\'s subdirectory (default: input_dir with '
+                             '_manifest.tsv added)')
+    parser.add_argument('--symlink', action='store_true',
+                        help='Leave the fast5 files in place and put symlinks to them in the '
+                             'subdirectories')
+    parser.add_argument('--dry_run', action='store_true',
+                        help='Only write the manifest, without making subdirectories or moving '
+                             'files')
+    parser.add_argument('--threads', type=int, required=False, default=8,
+                        help='Number of threads for moving/linking files')
 
-dir_num = 0
-while file_count > 0:
-    dir_name = input_dir + '/{:04d}'.format(dir_num)
-    os.makedirs(dir_name)
+    parser.add_argument('input_dir', type=str,
+                        help='Directory containing fast5 files')
+    parser.add_argument('target_reads_per_dir', type=int,
+                        help='Approximate number of reads for each subdirectory')
+
+    args = parser.parse_args()
+    if args.target_reads_per_dir < 1:
+        sys.exit('Error: target_reads_per_dir must be at least 1')
+    if args.threads < 1:
+        sys.exit('Error: --threads must be at least 1')
+    if args.manifest is None:
+        args.manifest = os.path.normpath(args.input_dir) + '_manifest.tsv'
+    return args
 
-    if file_count >= files_per_dir:
-        move_files = files_per_dir
+
+def main():
+    args = get_arguments()
+    input_dir = args.input_dir
+
+    fast5_files = sorted(glob.glob(input_dir + '/*.fast5'))
+    file_count = len(fast5_files)
+    print('Found {} fast5 files in {}'.format(file_count, input_dir))
+    if args.count_reads:
+        read_counts = [get_read_count(f) for f in fast5_files]
+        print('Found {} reads in the fast5 files'.format(sum(read_counts)))
     else:
-        move_files = file_count
-    print('Moving {} files to {}'.format(move_files, dir_name))
-    for f in fast5_files[:move_files]:
-        shutil.move(f, dir_name)
-
-    fast5_files = fast5_files[move_files:]
-    file_count -= move_files
-    dir_num += 1
+        read_counts = [1] * file_count
+    read_count = sum(read_counts)
+
+    dir_count = int(round(read_count / args.target_reads_per_dir))
+    if dir_count == 0:
+        dir_count = 1
+    reads_per_dir = int(math.ceil(read_count / dir_count))
+
+    partition = get_partition(input_dir, fast5_files, read_counts, reads_per_dir)
+    if args.dry_run:
+        action = 'Would link' if args.symlink else 'Would move'
+    else:
+        action = 'Linking' if args.symlink else 'Moving'
+    for dir_name, dir_files in partition:
+        print('{} {} files ({} reads) to {}'.format(action, len(dir_files),
+                                                    sum(reads for _, reads in dir_files),
+                                                    dir_name))
+
+    # The manifest is written first, so it shows where every file went even if the moves are
+    # interrupted.
+    write_manifest(args.manifest, partition)
+    print('Manifest written to {}'.format(args.manifest))
+    if args.dry_run:
+        return
+
+    # Each thread fills a whole directory at a time.
+    place_function = link_fast5 if args.symlink else move_fast5
+    methods = collections.Counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.threads) as executor:
+        placements = [executor.submit(fill_dir, place_function, dir_name, dir_files)
+                      for dir_name, dir_files in partition]
+        for placement in placements:
+            methods.update(placement.result())
+    for method in ['renamed', 'copied across filesystems', 'symlinked']:
+        if methods[method] > 0:
+            print('{}: {}'.format(method, methods[method]))
+
+
+def get_read_count(fast5_file):
+    # h5py (through fast5_utils) is only needed with --count_reads, so it's imported here.
+    import h5py
+    import fast5_utils
+    with h5py.File(fast5_file, 'r') as hdf5_file:
+        if fast5_utils.is_multi_read(hdf5_file):
+            return len(fast5_utils.get_reads(hdf5_file))
+        return 1
+
+
+def get_partition(input_dir, fast5_files, read_counts, reads_per_dir):
+    """
+    Splits the files (in order) between numbered subdirectories: files go into each directory until
+    it has enough reads. Returns (directory, [(file, read count), ...]) for each directory.
+    """
+    partition = []
+    i = 0
+    while i < len(fast5_files):
+        dir_name = input_dir + '/{:04d}'.format(len(partition))
+        dir_files, dir_reads = [], 0
+        while i < len(fast5_files) and dir_reads < reads_per_dir:
+            dir_files.append((fast5_files[i], read_counts[i]))
+            dir_reads += read_counts[i]
+            i += 1
+        partition.append((dir_name, dir_files))
+    return partition
+
+
+def write_manifest(manifest_filename, partition):
+    with open(manifest_filename, 'wt') as manifest:
+        manifest.write('file\tdirectory\treads\n')
+        for dir_name, dir_files in partition:
+            for fast5_file, reads in dir_files:
+                manifest.write('{}\t{}\t{}\n'.format(fast5_file, dir_name, reads))
+
+
+def fill_dir(place_function, dir_name, dir_files):
+    """
+    Makes a subdirectory and puts its files in it. Returns how many files were placed each way.
+    """
+    os.makedirs(dir_name)
+    return collections.Counter(place_function(f, dir_name) for f, _ in dir_files)
+
+
+def move_fast5(fast5_file, dir_name):
+    """
+    Moves a fast5 file into a directory and returns how it was done. A rename only changes the
+    directory entries, so the file is only copied (and then removed) if it's on another filesystem.
+    """
+    new_file = os.path.join(dir_name, os.path.basename(fast5_file))
+    try:
+        os.rename(fast5_file, new_file)
+        return 'renamed'
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    shutil.copy2(fast5_file, new_file)
+    os.remove(fast5_file)
+    return 'copied across filesystems'
+
+
+def link_fast5(fast5_file, dir_name):
+    """
+    Puts a symlink to a fast5 file in a directory. The link is relative, so it still works if the
+    whole input directory is moved.
+    """
+    new_file = os.path.join(dir_name, os.path.basename(fast5_file))
+    os.symlink(os.path.relpath(fast5_file, dir_name), new_file)
+    return 'symlinked'
+
+
+if __name__ == '__main__':
+    main()
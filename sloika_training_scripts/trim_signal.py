@@ -18,16 +18,28 @@ It does two steps for each read:
   2) Trim off a fixed amount of signal from the start and end of reads.
 
 The final result should be reads with no adapter sequence, making them more suitable for Sloika.
+
+The original fast5s are only read: the trim (or skip) is decided first, and then passing reads
+are written to new files, with the original's contents and the trimmed signal. Files can be
+trimmed in parallel (--threads), and --compression_level sets the gzip level of the new signal
+(lower levels are much faster and cost little in size).
+
+Both single-read and multi-read fast5s can be trimmed (see fast5_utils.py). By default, each input
+file gives one output file (of the same name) with its passing reads. With --batch_size, passing
+reads are instead gathered into multi-read files (batch_00000.fast5, etc.) of that many reads.
 """
 
 import argparse
+import collections
 import glob
 import h5py
+import multiprocessing
 import numpy as np
 import os
-import shutil
 import sys
 
+import fast5_utils
+
 
 def get_arguments():
     parser = argparse.ArgumentParser(description='Trim fast5 files at the signal level')
@@ -36,6 +48,13 @@ def get_arguments():
                         help='Signal values to be trimmed from the start/end of the signal')
     parser.add_argument('--min_size', type=int, required=False, default=50000,
                         help='Don\'t keep reads with a trimmed signal smaller than this')
+    parser.add_argument('--threads', type=int, required=False, default=1,
+                        help='Number of processes to use')
+    parser.add_argument('--compression_level', type=int, required=False, default=9,
+                        help='Gzip compression level (0-9) for the trimmed signal')
+    parser.add_argument('--batch_size', type=int, required=False, default=0,
+                        help='Write passing reads to multi-read fast5 files of this many reads '
+                             '(default: one output file for each input file)')
 
     parser.add_argument('in_dir', type=str,
                         help='Directory containing fast5 files to trim')
@@ -43,68 +62,205 @@ def get_arguments():
                         help='Output directory of trimmed fast5 files (will be made)')
 
     args = parser.parse_args()
+    if args.compression_level < 0 or args.compression_level > 9:
+        sys.exit('Error: --compression_level must be from 0 to 9')
     return args
 
 
 def main():
     args = get_arguments()
+    original_files = sorted(glob.glob(args.in_dir + '/**/*.fast5', recursive=True))
+    batched = args.batch_size > 0
+    if batched:
+        new_files = [None] * len(original_files)
+    else:
+        new_files = get_new_files(original_files, args.out_dir)
     make_output_dir(args.out_dir)
 
-    for original_file in glob.iglob(args.in_dir + '/**/*.fast5', recursive=True):
-        print(original_file)
+    # Without batches, each file is checked and written in one go. With batches, the files are
+    # first checked and then the passing reads are written in batches.
+    jobs = [(original_file, new_file, args.trim_amount, args.min_size, args.compression_level)
+            for original_file, new_file in zip(original_files, new_files)]
+    results = collections.Counter()
+    passing = []
+    for original_file, read_logs, file_passing in \
+            iterate_results(check_fast5 if batched else trim_fast5, jobs, args.threads):
+        print_read_logs(original_file, read_logs)
+        results['trimmed'] += len(file_passing)
+        results['skipped'] += len(read_logs) - len(file_passing)
+        if batched:
+            passing += [(original_file, read, trim) for read, trim in file_passing]
+
+    if batched:
+        batches = fast5_utils.get_batches(passing, args.batch_size)
+        jobs = [(fast5_utils.get_batch_filename(args.out_dir, i), batch, args.trim_amount,
+                 args.compression_level) for i, batch in enumerate(batches)]
+        for new_file, read_count in iterate_results(write_batch, jobs, args.threads):
+            print('{}: {:,} reads'.format(new_file, read_count))
+        print()
+    print('Trimmed: {:,}'.format(results['trimmed']))
+    print('Skipped: {:,}'.format(results['skipped']))
 
-        # Make a copy of the file which we will modify.       
-        new_file = '{}/{}'.format(args.out_dir, original_file.rpartition('/')[2])
-        print('    making a copy here: {}'.format(new_file))
-        if os.path.exists(new_file):
-            print()
-            sys.exit('Error: {} already exists'.format(new_file))
-        shutil.copyfile(original_file, new_file)
-
-        # Find the signal.
-        hdf5_file = h5py.File(new_file, 'r+')
-        signal_location = get_signal_location(hdf5_file)
-        read_location = signal_location.replace('/Signal', '')
-        signal = hdf5_file[signal_location].value
-        orignal_length = len(signal)
-        print('    original signal length = {:,}'.format(orignal_length))
-
-        # Trim off open-pore signal
-        try:
-            start_trim = find_signal_start_pos(signal)
-            print('    open-pore signal at start: {}'.format(start_trim))
-            end_trim = find_signal_start_pos(signal[::-1])
-            print('    open-pore signal at end: {}'.format(end_trim))
-        except CannotTrim:
-            print('    cannot trim - skipping')
-            hdf5_file.close()
-            os.remove(new_file)
-            continue
 
-        if start_trim + end_trim >= orignal_length:
-            print('    too short - skipping')
-            hdf5_file.close()
+def get_new_files(original_files, out_dir):
+    new_files = ['{}/{}'.format(out_dir, os.path.basename(f)) for f in original_files]
+    new_file_counts = collections.Counter(new_files)
+    for new_file in new_files:
+        if new_file_counts[new_file] > 1:
+            sys.exit('Error: more than one input file would be saved to {}'.format(new_file))
+    return new_files
+
+
+def iterate_results(function, jobs, threads):
+    """
+    Yields the result of the function for each job, in order. With more than one thread, the jobs
+    are run in a pool of worker processes.
+    """
+    if threads <= 1:
+        for job in jobs:
+            yield function(job)
+        return
+    pool = multiprocessing.Pool(threads)
+    try:
+        yield from pool.imap(function, jobs)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def print_read_logs(original_file, read_logs):
+    print(original_file)
+    for read_id, log in read_logs:
+        indent = '    '
+        if read_id is not None:
+            print('    read {}:'.format(read_id))
+            indent = '        '
+        for line in log:
+            print(indent + line)
+    print()
+
+
+def check_fast5(job):
+    """
+    Decides the trim for each read in a fast5 file, without writing anything. The original file is
+    only opened for reading. Returns the file, the log for each read and the passing reads (each
+    with its trim).
+    """
+    original_file, _, trim_amount, min_size, _ = job
+    read_logs, passing = [], []
+    with h5py.File(original_file, 'r') as hdf5_file:
+        multi_read = fast5_utils.is_multi_read(hdf5_file)
+        for read in fast5_utils.get_reads(hdf5_file):
+            log = []
+            read_logs.append((read.read_id if multi_read else None, log))
+            trim = get_trim(hdf5_file[read.signal_location][()], trim_amount, min_size, log)
+            if trim is not None:
+                passing.append((read, trim))
+    return original_file, read_logs, passing
+
+
+def trim_fast5(job):
+    """
+    Trims the reads in one fast5 file. The signal is read (and the trim decided) from the original
+    file, which is only opened for reading. Only passing reads are written to the new file (which
+    isn't made at all if no reads pass), so skipped reads never get copied.
+    """
+    original_file, new_file, trim_amount, min_size, compression_level = job
+    read_logs, passing = [], []
+    new_hdf5_file = None
+    try:
+        with h5py.File(original_file, 'r') as hdf5_file:
+            multi_read = fast5_utils.is_multi_read(hdf5_file)
+            for read in fast5_utils.get_reads(hdf5_file):
+                log = []
+                read_logs.append((read.read_id if multi_read else None, log))
+                signal = hdf5_file[read.signal_location][()]
+                trim = get_trim(signal, trim_amount, min_size, log)
+                if trim is None:
+                    continue
+                signal = apply_trim(signal, trim, trim_amount)
+                if new_hdf5_file is None:
+                    log.append('writing trimmed file: {}'.format(new_file))
+                    new_hdf5_file = fast5_utils.create_multi_read_file(new_file) if multi_read \
+                        else h5py.File(new_file, 'w-')
+                if multi_read:
+                    fast5_utils.copy_read(hdf5_file, read, new_hdf5_file, signal,
+                                          compression_level)
+                else:
+                    fast5_utils.copy_hdf5_group(hdf5_file, new_hdf5_file, read.signal_location)
+                    fast5_utils.write_signal(new_hdf5_file[read.raw_location], signal,
+                                             compression_level)
+                log.append('final trimmed signal length = {:,}'.format(len(signal)))
+                passing.append((read, trim))
+        if new_hdf5_file is not None:
+            new_hdf5_file.close()
+    except BaseException:
+        if new_hdf5_file is not None:
+            new_hdf5_file.close()
             os.remove(new_file)
-            continue
-        signal = signal[start_trim:-end_trim]
-        no_open_pore_length = len(signal)
-        print('    open-pore trimmed signal length = {:,}'.format(no_open_pore_length))
+        raise
+    return original_file, read_logs, passing
 
-        if no_open_pore_length - (2 * args.trim_amount) < args.min_size:
-            print('    too short - skipping')
-            hdf5_file.close()
+
+def write_batch(job):
+    """
+    Writes a batch of trimmed reads (from any number of original files) to one multi-read file.
+    """
+    new_file, batch, trim_amount, compression_level = job
+    hdf5_file = None
+    try:
+        with fast5_utils.create_multi_read_file(new_file) as new_hdf5_file:
+            for original_file, read, trim in batch:
+                if hdf5_file is None or hdf5_file.filename != original_file:
+                    if hdf5_file is not None:
+                        hdf5_file.close()
+                    hdf5_file = h5py.File(original_file, 'r')
+                signal = apply_trim(hdf5_file[read.signal_location][()], trim, trim_amount)
+                fast5_utils.copy_read(hdf5_file, read, new_hdf5_file, signal, compression_level)
+    except BaseException:
+        if os.path.exists(new_file):
             os.remove(new_file)
-        else:
-            # Trim the signal and rewrite it.
-            signal = signal[args.trim_amount:-args.trim_amount]
-            del hdf5_file[signal_location]
-            dset = hdf5_file.create_dataset(signal_location, compression='gzip',
-                                            compression_opts=9, data=signal)
-            new_length = len(signal)
-            hdf5_file[read_location].attrs['duration'] = new_length
-            print('    final trimmed signal length = {:,}'.format(new_length))
+        raise
+    finally:
+        if hdf5_file is not None:
             hdf5_file.close()
-        print()
+    return new_file, len(batch)
+
+
+def get_trim(signal, trim_amount, min_size, log):
+    """
+    Decides whether a read's signal can be trimmed, adding to the read's log along the way.
+    Returns the open-pore trim at the start and end, or None if the read should be skipped.
+    """
+    orignal_length = len(signal)
+    log.append('original signal length = {:,}'.format(orignal_length))
+
+    # Trim off open-pore signal
+    try:
+        start_trim = find_signal_start_pos(signal)
+        log.append('open-pore signal at start: {}'.format(start_trim))
+        end_trim = find_signal_start_pos(signal[::-1])
+        log.append('open-pore signal at end: {}'.format(end_trim))
+    except CannotTrim:
+        log.append('cannot trim - skipping')
+        return None
+
+    if start_trim + end_trim >= orignal_length:
+        log.append('too short - skipping')
+        return None
+    no_open_pore_length = orignal_length - start_trim - end_trim
+    log.append('open-pore trimmed signal length = {:,}'.format(no_open_pore_length))
+
+    if no_open_pore_length - (2 * trim_amount) < min_size:
+        log.append('too short - skipping')
+        return None
+    return start_trim, end_trim
+
+
+def apply_trim(signal, trim, trim_amount):
+    start_trim, end_trim = trim
+    signal = signal[start_trim:-end_trim]
+    return signal[trim_amount:-trim_amount]
 
 
 def make_output_dir(out_dir):
@@ -113,14 +269,6 @@ def make_output_dir(out_dir):
     os.makedirs(out_dir)
 
 
-def get_signal_location(hdf5_file):
-    names = []
-    hdf5_file.visit(names.append)
-    signal_locations = sorted([x for x in names if x.endswith('/Signal')])
-    assert len(signal_locations) == 1
-    return signal_locations[0]
-
-
 def find_signal_start_pos(signal):
     """
     Given a signal, this function attempts to identify the approximate position where the open
@@ -132,34 +280,50 @@ def find_signal_start_pos(signal):
     look_forward_windows = 5
     window_count_threshold = 4
 
-    # Always trim off the first few values as these are often dodgy.
-    pos = initial_trim_size
-
-    # Look at the stdev of the signal in the upcoming windows. Trimming is finished when:
-    #  1. the next window has a high stdev
-    #  2. enough of the other upcoming windows have a high stdev
-    while True:
-        next_window_stdev = get_window_stdev(signal, pos, 0, trim_increment)
-        if next_window_stdev > stdev_threshold:
-            upcoming_window_stdevs = [get_window_stdev(signal, pos, i, trim_increment)
-                                      for i in range(look_forward_windows)]
-            num_high_stdevs = sum(1 if x > stdev_threshold else 0
-                                  for x in upcoming_window_stdevs)
-            if num_high_stdevs >= window_count_threshold:
-                return pos
-        pos += trim_increment
+    # Always trim off the first few values as these are often dodgy. The rest of the signal is
+    # split into windows, and their stdevs are calculated a block at a time (with blocks growing in
+    # size), so reads with little open-pore signal don't need stdevs for the whole signal.
+    window_count = max(0, (len(signal) - initial_trim_size) // trim_increment)
+    block_start, block_size = 0, 64
+    while block_start < window_count:
+        block_end = min(block_start + block_size, window_count)
+        stdevs_end = min(block_end + look_forward_windows - 1, window_count)
+        block_signal = signal[initial_trim_size + block_start * trim_increment:
+                              initial_trim_size + stdevs_end * trim_increment]
+        high_stdev = get_window_stdevs(block_signal, trim_increment) > stdev_threshold
+
+        # Look at the stdev of the signal in the upcoming windows. Trimming is finished when:
+        #  1. the next window has a high stdev
+        #  2. enough of the other upcoming windows have a high stdev
+        # If the signal runs out while looking at the upcoming windows, it can't be trimmed.
+        window_nums = np.arange(block_end - block_start)
+        cumulative_high = np.concatenate(([0], np.cumsum(high_stdev)))
+        upcoming_ends = np.minimum(window_nums + look_forward_windows, len(high_stdev))
+        high_counts = cumulative_high[upcoming_ends] - cumulative_high[window_nums]
+        at_end = block_start + window_nums + look_forward_windows > window_count
+        finished = high_stdev[:len(window_nums)] & \
+            ((high_counts >= window_count_threshold) | at_end)
+        if finished.any():
+            window_num = int(np.argmax(finished))
+            if at_end[window_num]:
+                raise CannotTrim
+            return initial_trim_size + (block_start + window_num) * trim_increment
+        block_start = block_end
+        block_size *= 2
+    raise CannotTrim
 
 
 class CannotTrim(IndexError):
     pass
 
 
-def get_window_stdev(signal, current_pos, window_num, increment):
-    window_start = current_pos + (window_num * increment)
-    window_end = window_start + increment
-    if window_end > len(signal):
-        raise CannotTrim
-    return np.std(signal[window_start:window_end])
+def get_window_stdevs(signal, increment):
+    """
+    Returns the stdev of each whole window (of size increment) in the signal.
+    """
+    window_count = len(signal) // increment
+    windows = signal[:window_count * increment].reshape(window_count, increment)
+    return np.std(windows, axis=1)
 
 
 if __name__ == '__main__':